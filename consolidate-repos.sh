@@ -93,6 +93,7 @@ process-spkg () {
         sage_root)
             REPO=.
             BRANCH=base
+            PATH_MAP=(--path-map "spkg/bin=$SAGE_SCRIPTS_DIR" --path-map "spkg=$SAGE_BUILD")
 
             # apply WIP mecurial patches
             hg import http://trac.sagemath.org/sage_trac/raw-attachment/ticket/14226/trac14226_root.patch
@@ -100,6 +101,7 @@ process-spkg () {
         sage)
             REPO=$SAGE_SRC
             BRANCH=library
+            PATH_MAP=(--path-map "=$REPO/")
 
             # apply WIP mecurial patches
             hg import http://trac.sagemath.org/sage_trac/raw-attachment/ticket/14226/trac14226_library.patch
@@ -114,6 +116,7 @@ process-spkg () {
         sage_scripts)
             REPO=$SAGE_SCRIPTS_DIR
             BRANCH=devel/bin
+            PATH_MAP=(--path-map "=$REPO/")
 
             # apply WIP mecurial patches
             hg import http://trac.sagemath.org/sage_trac/raw-attachment/ticket/14226/trac14226_scripts.patch
@@ -121,10 +124,12 @@ process-spkg () {
         extcode)
             REPO=$SAGE_EXTDIR
             BRANCH=devel/ext
+            PATH_MAP=(--path-map "=$REPO/" --path-map "$REPO/sage/ext/mac-app=$SAGE_MACAPP")
         ;;
         *)
             REPO=$SAGE_PKGS/$PKGNAME
             BRANCH=packages/$PKGNAME
+            PATH_MAP=(--path-map "=$REPO/")
 
             rm .hgignore # hg add doesn't really add things if the file is supposed to be ignored
             case "$PKGNAME" in
@@ -151,17 +156,24 @@ process-spkg () {
     esac
     popd > /dev/null
 
+    # upstream sources are never exported, only listed as detracked
+    if [ "$REPO" != "." ]; then
+        DETRACK=(--exclude "$REPO/src/" --detracked "$OUTDIR"/detracked-files.txt)
+    else
+        DETRACK=()
+    fi
+
     # convert the SPKG's hg repo to git
     git init --bare "$TMPDIR"/spkg-git/$PKGNAME
     pushd "$TMPDIR"/spkg-git/$PKGNAME > /dev/null
-    $WORKFLOW_DIR/fast-export/hg-fast-export.sh -r "$TMPDIR"/spkg/$PKGNAME-$PKGVER -M master
+    # files are moved to their place in the consolidated repo by the
+    # --path-map rules and trailing whitespace is stripped while exporting
+    $WORKFLOW_DIR/fast-export/hg-fast-export.sh -r "$TMPDIR"/spkg/$PKGNAME-$PKGVER -M master \
+        "${PATH_MAP[@]}" "${DETRACK[@]}" --transform strip-whitespace
     rm -rf "$TMPDIR"/spkg/$PKGNAME-$PKGVER
 
-    # rewrite paths
-    # hacked into git-filter-branch so that we can use a bash array across
-    # commits (bash does not support exporting arrays)
-    export REPO SAGE_BUILD SAGE_MACAPP SAGE_SCRIPTS_DIR SAGE_EXTDIR
-    $WORKFLOW_DIR/git-filter-branch -f -d "$TMPDIR/filter-branch/$SPKG" --prune-empty --index-filter '' master
+    # drop the commits that became empty
+    $WORKFLOW_DIR/fast-export/gfifilter.py --prune-empty --fast-import "--force --quiet" master
     popd > /dev/null
 
     # pull it into the consolidated repo
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Benchmark whole conversions of synthetic repositories of various
+shapes with hg-fast-export.sh into scratch git repositories.
+
+For every scenario the wall time, the exporter's own time, revisions
+per second, stream bytes and the exporter's peak memory are recorded.
+With --baseline the results are compared against those of an earlier
+run saved with --save, and the exit status is 1 if a scenario got
+slower or bigger than the tolerance allows, or if one needed more memory
+than --max-rss. The deep scenario is meant for checking that
+--low-memory keeps memory flat:
+
+  export-bench.py -x --low-memory --max-rss 65536 deep"""
+
+from mercurial import ui
+from synthrepo import build_repo
+from optparse import OptionParser
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import sys
+
+# shapes of the scenarios, see synthrepo.default_shape; history has long
+# delta chains of few files, deep many small revisions
+scenarios={
+  'linear':{'revisions':2000,'files':200,'changes':5},
+  'wide':{'revisions':200,'files':20000,'changes':50},
+  'merges':{'revisions':1000,'files':1000,'changes':10,'branches':4,'merge_every':5},
+  'binaries':{'revisions':200,'files':50,'binaries':8,'binary_size':8<<20,'binary_every':5},
+  'tags':{'revisions':1000,'files':100,'changes':3,'tag_every':10},
+  'history':{'revisions':2000,'files':20,'file_size':64<<10,'changes':3,'edit':1},
+  'deep':{'revisions':100000,'files':20,'file_size':64,'changes':1},
+}
+
+# metrics where more is worse, compared against the baseline
+checked=('export_time','peak_rss')
+
+def scaled(shape,scale):
+  s=dict(shape)
+  for k in ('revisions','files'):
+    if k in s:
+      s[k]=max(int(s[k]*scale),2)
+  return s
+
+def run_export(repo,workdir,args):
+  """Convert repo into a new git repository in workdir and return the
+  wall time and the exporter's final statistics."""
+  git=os.path.join(workdir,'git')
+  subprocess.check_call(['git','init','-q',git])
+  statsfile=os.path.join(workdir,'stats')
+  script=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'hg-fast-export.sh')
+  log=open(os.path.join(workdir,'log'),'w')
+  start=time.time()
+  # hg-fast-export.sh only looks at the options before the first one it
+  # doesn't know
+  status=subprocess.call(['sh',script,'-r',repo]+args+['--stats',statsfile],
+      cwd=git,stdout=log,stderr=subprocess.STDOUT)
+  wall=time.time()-start
+  log.close()
+  if status!=0:
+    sys.stderr.write(open(os.path.join(workdir,'log')).read())
+    raise RuntimeError('hg-fast-export.sh failed with status %d' % status)
+  report=[json.loads(l) for l in open(statsfile)][-1]
+  if not report['final']:
+    raise RuntimeError('hg-fast-export.py died before its final report')
+  shutil.rmtree(git)
+  return wall,report
+
+def measure(repo,workdir,args,runs):
+  """Best of runs conversions of repo."""
+  best=None
+  for i in xrange(runs):
+    wall,report=run_export(repo,workdir,args)
+    result={
+      'wall':round(wall,3),
+      'export_time':report['elapsed'],
+      'revisions':report.get('revisions',0),
+      'revisions_per_s':report['revisions_per_s'],
+      'bytes':report.get('bytes',0),
+      'blobs':report.get('blobs',0),
+      'peak_rss':report['peak_rss'],
+      'phases':report['phases'],
+    }
+    if best==None or result['export_time']<best['export_time']:
+      best=result
+  return best
+
+def compare(name,result,baseline,tolerance):
+  """Print result against baseline and return the regressed metrics."""
+  regressed=[]
+  for metric in ('wall','export_time','revisions_per_s','bytes','peak_rss'):
+    old,new=baseline.get(metric),result[metric]
+    if not old:
+      continue
+    ratio=float(new)/old
+    mark=''
+    if metric in checked and ratio>1+tolerance:
+      regressed.append(metric)
+      mark=' REGRESSION'
+    print '  %-16s %12s -> %12s  (%.2fx)%s' % (metric,old,new,ratio,mark)
+  if baseline.get('bytes') and result['bytes']!=baseline['bytes']:
+    print '  note: the stream size changed, the exporter writes something else now'
+  return regressed
+
+if __name__=='__main__':
+  parser=OptionParser(usage='%prog [options] [scenario...]',
+      description='Scenarios: '+', '.join(sorted(scenarios)))
+  parser.add_option("--shape",action="append",dest="shape",default=[],
+      metavar="KEY=VALUE",help="Override a shape parameter of all scenarios")
+  parser.add_option("--scale",type="float",dest="scale",default=1.0,
+      help="Scale the number of revisions and files of all scenarios")
+  parser.add_option("-r","--runs",type="int",dest="runs",default=3,
+      help="Take the best of this many runs")
+  parser.add_option("--baseline",dest="baseline",
+      help="Compare against the results in BASELINE")
+  parser.add_option("--save",dest="save",
+      help="Save the results to SAVE, to be used as a baseline")
+  parser.add_option("--tolerance",type="float",dest="tolerance",default=0.2,
+      help="Allowed slowdown or memory growth against the baseline (0.2 is 20%)")
+  parser.add_option("--max-rss",type="int",dest="max_rss",
+      help="Fail if the exporter's peak memory exceeds MAX_RSS KB in a scenario")
+  parser.add_option("-x","--export-option",action="append",dest="export_args",
+      default=[],metavar="OPTION",help="Pass OPTION on to hg-fast-export.sh")
+  parser.add_option("--keep",dest="keep",
+      help="Keep the generated repositories in KEEP and reuse them")
+  (options,args)=parser.parse_args()
+
+  names=args or sorted(scenarios)
+  for name in names:
+    if name not in scenarios:
+      parser.error('unknown scenario %s' % name)
+  overrides={}
+  for o in options.shape:
+    k,v=o.split('=',1)
+    overrides[k]=int(v)
+
+  baseline={}
+  if options.baseline!=None:
+    baseline=json.load(open(options.baseline))
+
+  repodir=options.keep or tempfile.mkdtemp(prefix='export-bench.')
+  workdir=tempfile.mkdtemp(prefix='export-bench-work.')
+  results={}
+  regressed=[]
+  try:
+    for name in names:
+      shape=scaled(scenarios[name],options.scale)
+      shape.update(overrides)
+      repo=os.path.join(repodir,name+'-'+'-'.join('%s%d' % i for i in sorted(shape.items())))
+      if not os.path.isdir(repo):
+        sys.stderr.write('Building %s repository: %s\n' % (name,shape))
+        build_repo(ui.ui(),repo,shape)
+      sys.stderr.write('Converting %s\n' % name)
+      results[name]=measure(repo,workdir,options.export_args,options.runs)
+      r=results[name]
+      print '%s: %.3fs wall, %.3fs export, %.1f revisions/s, %d bytes, %d KB peak' % (
+          name,r['wall'],r['export_time'],r['revisions_per_s'],r['bytes'],r['peak_rss'])
+      if name in baseline:
+        regressed+=['%s %s' % (name,m) for m in
+            compare(name,r,baseline[name],options.tolerance)]
+      if options.max_rss!=None and r['peak_rss']>options.max_rss:
+        print '  peak_rss %d KB is above --max-rss %d KB' % (r['peak_rss'],options.max_rss)
+        regressed.append('%s peak_rss' % name)
+  finally:
+    shutil.rmtree(workdir)
+    if options.keep==None:
+      shutil.rmtree(repodir)
+
+  if options.save!=None:
+    f=open(options.save,'w')
+    json.dump(results,f,indent=1,sort_keys=True)
+    f.write('\n')
+    f.close()
+
+  if regressed:
+    sys.stderr.write('Regressions: %s\n' % ', '.join(regressed))
+    sys.exit(1)
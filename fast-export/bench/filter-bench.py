@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Benchmark gfifilter.py against the per-commit shell loop that
+consolidate-repos.sh used to run in git-filter-branch to move an SPKG's
+files under build/pkgs/<name>/, strip trailing whitespace and detrack
+its src/ directory, followed by --prune-empty.
+
+Both rewrite a copy of the same git repository, the converted history
+of an SPKG given with --repo (hg-fast-export.sh without any rewriting
+options) or else a generated one, and their trees are compared commit
+by commit."""
+
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import sys
+
+# the index filter as it was in git-filter-branch for REPO!=.
+old_filter=r'''
+if [ -z "$NULL_OBJECT" ]; then
+  NULL_OBJECT=`git hash-object -w /dev/null`
+  BINARY_NUMSTAT=$(printf '%s\t-\t' -)
+  declare -A GIT_OBJ_DICT
+  is-binary () {
+    diffstat="`git diff --numstat $NULL_OBJECT $1`"
+    case $diffstat in
+      "$BINARY_NUMSTAT"*) return 0 ;;
+      *) return 1 ;;
+    esac
+  }
+fi
+if [ "${#parents}" != "40" ]; then
+  readarray -t < <(git ls-files -s | sed "s/\t/ /" | cut -f1,2,4)
+else
+  readarray -t < <(git diff-tree -r --no-commit-id $parents $commit | sed "s/\t/ /" | cut -f2,4,6 -d' ')
+fi
+for line in "${MAPFILE[@]}"
+do
+  object="${line:7:40}"
+  if [ -z "${GIT_OBJ_DICT[X$object]}" ]; then
+    if [ "${line:0:2}" != "10" ]; then
+      new_object=$object
+    elif is-binary $object; then
+      new_object=$object
+    elif [ "${line: -6}" == ".patch" -o "${line: -5}" == ".diff" ]; then
+      new_object=$object
+    else
+      new_object=`git cat-file -p $object | sed 's+\s*$++' | git hash-object -w --stdin`
+    fi
+    GIT_OBJ_DICT[X$object]=$new_object
+  fi
+done
+git ls-files -s |
+  {
+  while read a object b c
+  do
+    echo -e "$a ${GIT_OBJ_DICT[X$object]} $b\t$c"
+  done
+  } |
+    sed "s+\t+&$REPO/+" |
+      GIT_INDEX_FILE=$GIT_INDEX_FILE.new git update-index --index-info &&
+        mv $GIT_INDEX_FILE.new $GIT_INDEX_FILE
+git rm -rf --cached --ignore-unmatch $REPO/src/ >> $OUTDIR/detracked-files.txt
+'''
+
+def generate(path,commits,files):
+  """Create a git repository of commits commits to files files, a few
+  of them in src/ and patches/, every third commit only changing
+  trailing whitespace."""
+  subprocess.check_call(['git','init','-q','--bare',path])
+  fi=subprocess.Popen(['git','fast-import','--quiet'],cwd=path,stdin=subprocess.PIPE)
+  w=fi.stdin
+  names=['file%d.txt' % i for i in xrange(files)]
+  names+=['src/upstream%d.c' % i for i in xrange(files/10+1)]
+  names+=['patches/fix%d.patch' % i for i in xrange(files/20+1)]
+  # last contents of every file but for whitespace
+  last={}
+  for c in xrange(commits):
+    w.write('commit refs/heads/master\ncommitter Bench <bench@example.com> %d +0000\n' % c)
+    w.write('data 9\ncommit %d\n' % (c%10))
+    changed=c==0 and names or [names[(c*7+i)%len(names)] for i in xrange(3)]
+    for name in changed:
+      if c%3==2 and name in last:
+        # the same text with other trailing whitespace
+        d=last[name].replace('\n',' '*(c%4)+'\n')
+      else:
+        d=last[name]=''.join('line %d of %s in %d\n' % (l,name,c) for l in xrange(20))
+      w.write('M 644 inline %s\ndata %d\n%s\n' % (name,len(d),d))
+    w.write('\n')
+  w.close()
+  if fi.wait()!=0:
+    raise RuntimeError('git fast-import failed')
+
+def trees(path):
+  return subprocess.Popen(['git','log','--format=%T','master'],cwd=path,
+      stdout=subprocess.PIPE).communicate()[0].split()
+
+def run_old(repo,workdir,pkg):
+  clone=os.path.join(workdir,'old')
+  subprocess.check_call(['git','clone','-q',repo,clone])
+  # git's own, run by bash for the arrays of the index filter
+  execpath=subprocess.check_output(['git','--exec-path']).strip()
+  script=os.path.join(execpath,'git-filter-branch')
+  env=dict(os.environ)
+  env['PATH']=env['PATH']+':'+execpath
+  env['FILTER_BRANCH_SQUELCH_WARNING']='1'
+  env['REPO']='build/pkgs/'+pkg
+  env['OUTDIR']=workdir
+  start=time.time()
+  subprocess.check_call(['bash',script,'-f','-d',os.path.join(workdir,'filter-branch'),
+      '--prune-empty','--index-filter',old_filter,'master'],
+      cwd=clone,env=env,stdout=open(os.devnull,'w'),stderr=subprocess.STDOUT)
+  return time.time()-start,trees(clone)
+
+def run_new(repo,workdir,pkg):
+  clone=os.path.join(workdir,'new')
+  subprocess.check_call(['git','clone','-q','--mirror',repo,clone])
+  script=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'gfifilter.py')
+  prefix='build/pkgs/%s/' % pkg
+  start=time.time()
+  subprocess.check_call([sys.executable,script,'--path-map','='+prefix,
+      '--exclude',prefix+'src/','--detracked',os.path.join(workdir,'detracked-new.txt'),
+      '--transform','strip-whitespace','--prune-empty',
+      '--fast-import','--force --quiet','master'],cwd=clone)
+  return time.time()-start,trees(clone)
+
+if __name__=='__main__':
+  parser=OptionParser(usage='%prog [options]')
+  parser.add_option("--repo",dest="repo",
+      help="Rewrite the master branch of the git repository REPO")
+  parser.add_option("--package",dest="package",default='bench',
+      help="Name of the package, its files go to build/pkgs/PACKAGE/")
+  parser.add_option("--commits",type="int",dest="commits",default=500,
+      help="Commits of the generated repository")
+  parser.add_option("--files",type="int",dest="files",default=200,
+      help="Files of the generated repository")
+  (options,args)=parser.parse_args()
+
+  workdir=tempfile.mkdtemp(prefix='filter-bench.')
+  try:
+    repo=options.repo
+    if repo==None:
+      repo=os.path.join(workdir,'repo.git')
+      sys.stderr.write('Generating %d commits of %d files\n' % (options.commits,options.files))
+      generate(repo,options.commits,options.files)
+    old,old_trees=run_old(repo,workdir,options.package)
+    new,new_trees=run_new(repo,workdir,options.package)
+    print 'git-filter-branch %8.3fs  %d commits' % (old,len(old_trees))
+    print 'gfifilter.py      %8.3fs  %d commits  (%.1fx)' % (new,len(new_trees),old/new)
+    if old_trees!=new_trees:
+      print 'the rewritten trees differ'
+      sys.exit(1)
+  finally:
+    shutil.rmtree(workdir)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Benchmark change detection for a merge of two branches of a
+repository with many files, comparing hg-fast-export's manifest diff
+based get_filechanges() against the old loop over every manifest entry."""
+
+from mercurial import ui,hg,node
+from synthrepo import load_exporter,create_repo,commit,file_data
+from optparse import OptionParser
+import shutil
+import tempfile
+import time
+import sys
+
+def file_mismatch(f1,f2):
+  return node.hex(f1)!=node.hex(f2)
+
+def split_dict(dleft,dright,l,c,r,match=file_mismatch):
+  for left in dleft.keys():
+    right=dright.get(left,None)
+    if right==None:
+      l.append(left)
+    elif match(dleft[left],right):
+      c.append(left)
+  for right in dright.keys():
+    left=dleft.get(right,None)
+    if left==None:
+      r.append(right)
+  return l,c,r
+
+def loop_filechanges(repo,revision,parents):
+  """Change detection as done by hg-fast-export before manifest diffs."""
+  l,c,r=[],[],[]
+  mleft=repo.changectx(revision).manifest()
+  for p in parents:
+    mright=repo.changectx(p).manifest()
+    l,c,r=split_dict(mleft,mright,l,c,r)
+  l.sort()
+  c.sort()
+  r.sort()
+  return l,c,r
+
+def build(myui,path,nfiles,nchanged):
+  repo=create_repo(myui,path)
+  root=commit(repo,[],dict((('f%06d' % i,file_data(i)) for i in xrange(nfiles))),'root')
+  # each side changes its own share of the files, adds some and removes some
+  left=dict((('f%06d' % i,file_data(i,1)) for i in xrange(0,nchanged)))
+  left.update((('left%06d' % i,file_data(i,1)) for i in xrange(nchanged/10)))
+  left.update((('f%06d' % i,None) for i in xrange(nfiles-nchanged/10,nfiles)))
+  p1=commit(repo,[root],left,'left',date=1)
+  right=dict((('f%06d' % i,file_data(i,2)) for i in xrange(nchanged,2*nchanged)))
+  right.update((('right%06d' % i,file_data(i,2)) for i in xrange(nchanged/10)))
+  p2=commit(repo,[root],right,'right',date=2,branch='other')
+  merged=dict(left)
+  merged.update(right)
+  commit(repo,[p1,p2],merged,'merge',date=3)
+  return repo
+
+def measure(path,fn,runs):
+  best=None
+  for i in xrange(runs):
+    # start from a cold repository object so no manifest is cached
+    repo=hg.repository(ui.ui(),path)
+    rev=len(repo)-1
+    parents=[p for p in repo.changelog.parentrevs(rev) if p>=0]
+    start=time.time()
+    result=fn(repo,rev,parents)
+    elapsed=time.time()-start
+    if best==None or elapsed<best: best=elapsed
+  return best,result
+
+if __name__=='__main__':
+  parser=OptionParser()
+  parser.add_option("-n","--files",type="int",dest="files",default=20000,
+      help="Number of files in the manifest")
+  parser.add_option("-c","--changed",type="int",dest="changed",default=500,
+      help="Number of files changed on each side of the merge")
+  parser.add_option("-r","--runs",type="int",dest="runs",default=5,
+      help="Take the best of this many runs")
+  (options,args)=parser.parse_args()
+
+  exporter=load_exporter()
+  def delta_filechanges(repo,rev,parents):
+    return exporter.get_filechanges(repo,repo.changelog.read(repo.changelog.node(rev))[0],parents)
+
+  path=tempfile.mkdtemp(prefix='merge-bench.')
+  try:
+    sys.stderr.write('Building repository with %d files in %s\n' % (options.files,path))
+    build(ui.ui(),path,options.files,options.changed)
+    old,expected=measure(path,loop_filechanges,options.runs)
+    new,result=measure(path,delta_filechanges,options.runs)
+    if result!=expected:
+      sys.stderr.write('Error: manifest diff result differs from full comparison\n')
+      sys.exit(1)
+    print 'files: %d, added/changed/removed: %d/%d/%d' % ((options.files,)+tuple(map(len,result)))
+    print 'manifest loop: %.4fs' % old
+    print 'manifest diff: %.4fs (%.1fx)' % (new,old/new)
+  finally:
+    shutil.rmtree(path)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Benchmark svn-fast-export.py on a generated local Subversion
+repository with a long history.
+
+The repository is built with svnadmin load from a generated dump, which
+takes seconds for tens of thousands of revisions where committing them
+one by one would take hours. Every revision changes a few files of
+trunk, some add a directory, delete a file or change a file outside of
+trunk. The revision walk of svn-fast-export, which takes the node kind
+from the changed-path records, is timed against the old one asking the
+tree with svn_fs_is_dir for every changed path in a pool of its own,
+and then a whole conversion into a scratch git repository is timed."""
+
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import sys
+
+default_shape={
+  'revisions':20000,
+  'files':200,
+  'changes':2,
+  'file_size':256,
+  # every that many revisions a directory with a file is added
+  'dir_every':50,
+  # every that many revisions a file is deleted
+  'delete_every':100,
+  # every that many revisions a file outside of trunk is changed
+  'branch_every':10,
+}
+
+def props(p):
+  s=''.join('K %d\n%s\nV %d\n%s\n' % (len(k),k,len(v),v) for k,v in p)
+  return s+'PROPS-END\n'
+
+def node(path,kind,action,text=None):
+  """Dump record of a node, a file's text replaced by text."""
+  lines=['Node-path: %s' % path]
+  if kind!=None:
+    lines.append('Node-kind: %s' % kind)
+  lines.append('Node-action: %s' % action)
+  if action=='delete':
+    return '\n'.join(lines)+'\n\n'
+  p=action=='add' and props([]) or ''
+  if p:
+    lines.append('Prop-content-length: %d' % len(p))
+  if text!=None:
+    lines.append('Text-content-length: %d' % len(text))
+  lines.append('Content-length: %d' % (len(p)+len(text or '')))
+  return '\n'.join(lines)+'\n\n'+p+(text or '')+'\n\n'
+
+def file_text(name,rev,size):
+  line='%s changed in r%d\n' % (name,rev)
+  return (line*(size/len(line)+1))[:size]
+
+def write_dump(f,shape):
+  """Write the dump of a repository of the given shape to f."""
+  f.write('SVN-fs-dump-format-version: 2\n\n')
+  def revision(rev,nodes):
+    p=props([('svn:log','r%d' % rev),('svn:author','bench'),
+        ('svn:date','2008-01-01T%02d:%02d:%02d.000000Z' % (rev/3600%24,rev/60%60,rev%60))])
+    f.write('Revision-number: %d\nProp-content-length: %d\nContent-length: %d\n\n%s\n' %
+        (rev,len(p),len(p),p))
+    f.writelines(nodes)
+  revision(0,[])
+  size=shape['file_size']
+  files=['trunk/f%d' % i for i in xrange(shape['files'])]
+  nodes=[node('trunk','dir','add'),node('branches','dir','add'),
+      node('branches/work','dir','add'),node('branches/work/f','file','add','')]
+  nodes+=[node(name,'file','add',file_text(name,1,size)) for name in files]
+  revision(1,nodes)
+  for rev in xrange(2,shape['revisions']+1):
+    nodes=[]
+    if rev%shape['delete_every']==0 and len(files)>shape['changes']:
+      nodes.append(node(files.pop(),None,'delete'))
+    for i in xrange(shape['changes']):
+      name=files[(rev*shape['changes']+i)%len(files)]
+      nodes.append(node(name,'file','change',file_text(name,rev,size)))
+    if rev%shape['dir_every']==0:
+      d='trunk/d%d' % rev
+      nodes+=[node(d,'dir','add'),node(d+'/f','file','add',file_text(d,rev,size))]
+    if rev%shape['branch_every']==0:
+      nodes.append(node('branches/work/f','file','change',file_text('work',rev,size)))
+    revision(rev,nodes)
+
+def build_repo(path,shape):
+  subprocess.check_call(['svnadmin','create',path])
+  load=subprocess.Popen(['svnadmin','load','--quiet',path],stdin=subprocess.PIPE)
+  write_dump(load.stdin,shape)
+  load.stdin.close()
+  if load.wait()!=0:
+    raise RuntimeError('svnadmin load failed')
+
+def probe_walk(fs_obj,pool,youngest):
+  """The revision walk as done by svn-fast-export before the node kind
+  was taken from the changed-path records."""
+  from svn.fs import svn_fs_revision_root,svn_fs_paths_changed,svn_fs_is_dir
+  from svn.core import svn_pool_create,svn_pool_clear,svn_pool_destroy
+  seen=0
+  for rev in xrange(1,youngest+1):
+    revpool=svn_pool_create(pool)
+    svn_pool_clear(revpool)
+    root=svn_fs_revision_root(fs_obj,rev,revpool)
+    for path,change in svn_fs_paths_changed(root,revpool).iteritems():
+      if svn_fs_is_dir(root,path,revpool):
+        continue
+      if path.startswith('/trunk/'):
+        seen+=1
+    svn_pool_destroy(revpool)
+  return seen
+
+def kind_walk(fs_obj,pool,youngest):
+  """The revision walk of svn-fast-export."""
+  from svn.fs import svn_fs_revision_root,svn_fs_paths_changed2,svn_fs_check_path
+  from svn.core import svn_pool_create,svn_pool_clear,svn_pool_destroy,svn_node_dir,svn_node_unknown
+  seen=0
+  revpool=svn_pool_create(pool)
+  for rev in xrange(1,youngest+1):
+    svn_pool_clear(revpool)
+    root=svn_fs_revision_root(fs_obj,rev,revpool)
+    for path,change in svn_fs_paths_changed2(root,revpool).iteritems():
+      if not path.startswith('/trunk/'):
+        continue
+      kind=change.node_kind
+      if kind==svn_node_unknown:
+        kind=svn_fs_check_path(root,path,revpool)
+      if kind!=svn_node_dir or change.change_kind==2:
+        seen+=1
+  svn_pool_destroy(revpool)
+  return seen
+
+def time_walks(pool,path):
+  from svn.repos import svn_repos_open,svn_repos_fs
+  from svn.fs import svn_fs_youngest_rev
+  fs_obj=svn_repos_fs(svn_repos_open(path,pool))
+  youngest=svn_fs_youngest_rev(fs_obj,pool)
+  results=[]
+  for walk in (probe_walk,kind_walk):
+    start=time.time()
+    seen=walk(fs_obj,pool,youngest)
+    results.append((walk.__name__,time.time()-start,seen))
+  return youngest,results
+
+def time_export(path,args):
+  """Convert the repository at path into a scratch git repository and
+  return the wall time."""
+  git=tempfile.mkdtemp(prefix='svn-bench-git.')
+  try:
+    subprocess.check_call(['git','init','-q',git])
+    script=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'svn-fast-export.py')
+    log=open(os.path.join(git,'log'),'w')
+    start=time.time()
+    status=subprocess.call([sys.executable,script]+args+['--fast-import','--quiet',path],
+        cwd=git,stderr=log)
+    wall=time.time()-start
+    log.close()
+    if status!=0:
+      sys.stderr.write(open(os.path.join(git,'log')).read())
+      raise RuntimeError('svn-fast-export.py failed with status %d' % status)
+    return wall
+  finally:
+    shutil.rmtree(git)
+
+if __name__=='__main__':
+  parser=OptionParser(usage='%prog [options]')
+  parser.add_option("--shape",action="append",dest="shape",default=[],
+      metavar="KEY=VALUE",help="Override a shape parameter: "+
+      ', '.join('%s=%d' % i for i in sorted(default_shape.items())))
+  parser.add_option("-x","--export-option",action="append",dest="export_args",
+      default=[],metavar="OPTION",help="Pass OPTION on to svn-fast-export.py")
+  parser.add_option("--keep",dest="keep",
+      help="Keep the generated repository in KEEP and reuse it")
+  parser.add_option("--no-export",action="store_false",dest="export",default=True,
+      help="Only time the revision walks")
+  (options,args)=parser.parse_args()
+
+  shape=dict(default_shape)
+  for o in options.shape:
+    k,v=o.split('=',1)
+    if k not in shape:
+      parser.error('unknown shape parameter %s' % k)
+    shape[k]=int(v)
+
+  repodir=options.keep or tempfile.mkdtemp(prefix='svn-bench.')
+  try:
+    repo=os.path.join(repodir,'-'.join('%s%d' % i for i in sorted(shape.items())))
+    if not os.path.isdir(repo):
+      sys.stderr.write('Building repository: %s\n' % shape)
+      start=time.time()
+      build_repo(repo,shape)
+      sys.stderr.write('Built in %.1fs\n' % (time.time()-start))
+
+    from svn.core import run_app
+    youngest,results=run_app(time_walks,repo)
+    for name,elapsed,seen in results:
+      print '%-10s %8.3fs  %9.1f revisions/s  %d changed files' % (
+          name,elapsed,youngest/elapsed,seen)
+    if results[0][2]!=results[1][2]:
+      print 'note: the walks disagree on the changed files'
+    if options.export:
+      wall=time_export(repo,options.export_args)
+      print 'export     %8.3fs  %9.1f revisions/s' % (wall,youngest/wall)
+  finally:
+    if options.keep==None:
+      shutil.rmtree(repodir)
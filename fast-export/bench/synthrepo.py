@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Helpers to build synthetic local Mercurial repositories for the
+benchmarks in this directory."""
+
+from mercurial import hg,context,node
+import os
+import sys
+import imp
+import random
+
+def load_exporter():
+  """Import hg-fast-export.py, whose name isn't a valid module name."""
+  root=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)
+  sys.path.insert(0,root)
+  return imp.load_source('hg_fast_export',os.path.join(root,'hg-fast-export.py'))
+
+def create_repo(ui,path):
+  return hg.repository(ui,path,create=True)
+
+def commit(repo,parents,files,text,user='Bench <bench@example.com>',
+    date=0,branch='default'):
+  """Commit files, a dict of path -> data (None removes the path), on
+  top of up to two parent nodes and return the new node."""
+  def filectxfn(repo,mctx,path):
+    data=files[path]
+    if data==None:
+      raise IOError(path)
+    return context.memfilectx(path,data,False,False,None)
+  parents=(list(parents)+[node.nullid,node.nullid])[:2]
+  ctx=context.memctx(repo,parents,text,sorted(files.keys()),filectxfn,
+      user,'%d 0' % date,{'branch':branch})
+  return repo.commitctx(ctx)
+
+def file_data(i,rev=0,size=64):
+  """Deterministic content for file i as of some revision."""
+  line='file %d revision %d\n' % (i,rev)
+  return line*(size/len(line)+1)
+
+def edit_data(d,rev):
+  """Data d with one of its lines changed, as of some revision."""
+  lines=d.split('\n')
+  lines[rev%len(lines)]='edited in revision %d' % rev
+  return '\n'.join(lines)
+
+def binary_data(seed,size):
+  """Deterministic incompressible data with a NUL byte up front, so git
+  takes it for binary."""
+  r=random.Random(seed)
+  return '\0'+('%0*x' % (2*(size-1),r.getrandbits(8*(size-1)))).decode('hex')
+
+# shape of a generated repository, see build_repo()
+default_shape={
+  'revisions':100,    # number of revisions, tag commits not counted
+  'files':100,        # files in the manifest of the root revision
+  'file_size':256,    # size of a text file
+  'changes':5,        # files changed per revision
+  'edit':0,           # change a line of a file instead of rewriting it
+  'branches':1,       # named branches, including default
+  'merge_every':0,    # merge another branch into default every n revisions
+  'binaries':0,       # number of large binary files
+  'binary_size':1<<20,
+  'binary_every':10,  # change one of the binaries every n revisions
+  'tag_every':0,      # tag default every n revisions
+  'seed':0,
+}
+
+def build_repo(ui,path,shape):
+  """Build a repository of the given shape, see default_shape, in path
+  and return it. The same shape always gives the same repository."""
+  s=dict(default_shape)
+  s.update(shape)
+  r=random.Random(s['seed'])
+  # hg walks the descendants of all draft roots on every commit, which
+  # makes building long histories quadratic
+  ui=ui.copy()
+  ui.setconfig('phases','new-commit','public')
+  repo=create_repo(ui,path)
+  branches=['default']+['branch%d' % i for i in xrange(1,s['branches'])]
+  files=dict(('f%06d' % i,file_data(i,0,s['file_size'])) for i in xrange(s['files']))
+  files.update(('bin%03d' % i,binary_data(i,s['binary_size'])) for i in xrange(s['binaries']))
+  heads={'default':commit(repo,[],files,'root')}
+  # manifest contents of each branch head
+  state={'default':files}
+  tags=''
+  date=0
+  for rev in xrange(1,s['revisions']):
+    date+=1
+    branch=branches[rev%len(branches)]
+    if s['merge_every'] and rev%s['merge_every']==0 and len(branches)>1:
+      # merge a branch that has commits of its own into default
+      other=branches[1+(rev/s['merge_every'])%(len(branches)-1)]
+      if other in heads:
+        p1=state['default']
+        merged=dict(p1)
+        merged.update(state[other])
+        changed=dict((f,d) for f,d in merged.iteritems() if p1.get(f)!=d)
+        heads['default']=commit(repo,[heads['default'],heads[other]],changed,
+            'merge %s at %d' % (other,rev),date=date)
+        state['default']=merged
+        continue
+    if branch not in heads:
+      heads[branch]=heads['default']
+      state[branch]=dict(state['default'])
+    changed={}
+    for i in r.sample(xrange(s['files']),min(s['changes'],s['files'])):
+      f='f%06d' % i
+      if s['edit']:
+        changed[f]=edit_data(state[branch][f],rev)
+      else:
+        changed[f]=file_data(i,rev,s['file_size'])
+    if s['binaries'] and rev%s['binary_every']==0:
+      i=r.randrange(s['binaries'])
+      changed['bin%03d' % i]=binary_data(rev*1000+i,s['binary_size'])
+    heads[branch]=commit(repo,[heads[branch]],changed,'revision %d' % rev,
+        date=date,branch=branch)
+    state[branch].update(changed)
+    if s['tag_every'] and branch=='default' and rev%s['tag_every']==0:
+      date+=1
+      tags+='%s v%d\n' % (node.hex(heads['default']),rev)
+      heads['default']=commit(repo,[heads['default']],{'.hgtags':tags},
+          'tag v%d' % rev,date=date)
+  return repo
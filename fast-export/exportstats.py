@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Per-phase timings and throughput counters for the fast-export scripts,
+reported as JSON lines on a side channel."""
+
+import heapq
+import json
+import resource
+import time
+
+now=time.time
+
+# emit a report at most every this many seconds
+cfg_stats_interval=10
+# number of slowest revisions to report
+cfg_slowest_revisions=10
+
+class export_stats(object):
+  def __init__(self,out=None,interval=cfg_stats_interval,slowest=cfg_slowest_revisions):
+    self.out=out
+    self.interval=interval
+    self.nslowest=slowest
+    self.start=self.last=time.time()
+    self.phases={}
+    self.counters={}
+    # (prefix,dict) of counters kept elsewhere, see watch()
+    self.watched=[]
+    # (seconds,revision) of the slowest revisions, a heap
+    self.slowest=[]
+
+  def add(self,phase,since):
+    """Account the time passed since timestamp 'since' to phase and
+    return the current time, so that phases can be chained."""
+    now=time.time()
+    self.phases[phase]=self.phases.get(phase,0.0)+now-since
+    return now
+
+  def count(self,what,n=1):
+    self.counters[what]=self.counters.get(what,0)+n
+
+  def watch(self,prefix,counters):
+    """Include the counters of another module, a dict updated in place,
+    in every report with their names prefixed by prefix."""
+    self.watched.append((prefix,counters))
+
+  def revision(self,rev,since):
+    """Note that revision rev was exported, having started at 'since'."""
+    now=time.time()
+    self.count('revisions')
+    if len(self.slowest)<self.nslowest:
+      heapq.heappush(self.slowest,(now-since,rev))
+    elif now-since>self.slowest[0][0]:
+      heapq.heapreplace(self.slowest,(now-since,rev))
+    if now-self.last>=self.interval:
+      self.emit()
+
+  def report(self,final=False):
+    now=time.time()
+    elapsed=max(now-self.start,1e-9)
+    r={'elapsed':round(elapsed,3),'final':final}
+    r.update(self.counters)
+    for prefix,counters in self.watched:
+      r.update((prefix+k,v) for k,v in counters.iteritems())
+    for what in ('revisions','blobs','bytes'):
+      r[what+'_per_s']=round(r.get(what,0)/elapsed,1)
+    r['phases']=dict((k,round(v,3)) for k,v in self.phases.iteritems())
+    r['slowest']=[[rev,round(s,3)] for s,rev in sorted(self.slowest,reverse=True)]
+    # kilobytes on Linux
+    r['peak_rss']=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r
+
+  def emit(self,final=False):
+    self.last=time.time()
+    if self.out!=None:
+      self.out.write(json.dumps(self.report(final),sort_keys=True)+'\n')
+      self.out.flush()
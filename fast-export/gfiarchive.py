@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Archive of the git-fast-import streams written by hg-fast-export.py,
+to be replayed into git-fast-import without Mercurial.
+
+An archive is a directory of gzip segments and an index. Each line of
+the index names a revision, or t for stream written outside of one
+(like tags), the segment holding its part of the stream and the offset
+and length of that part in the uncompressed segment. A run starts a
+new segment, and so does a segment growing beyond cfg_segment_size.
+Replaying from the middle of a segment only decompresses that one
+segment up to there, and a checkpoint is replayed between segments.
+
+Segments are flushed and the index is appended to at checkpoints and
+at the end of a run only, so the archive of an export that died holds
+whole revisions only. Revisions exported again by a later run are
+archived again and replayed twice: the later run may refer to blobs
+written by the first one by SHA1."""
+
+from optparse import OptionParser
+import gfiwriter
+import gzip
+import os
+import sys
+import zlib
+
+# start a new segment once this many bytes of stream are in one
+cfg_segment_size=64<<20
+# size of the pieces segments are read in
+cfg_read_size=1<<20
+
+def index_file(path):
+  return os.path.join(path,'index')
+
+def segment_file(path,segment):
+  return os.path.join(path,'%06d.gz' % segment)
+
+def read_index(path):
+  """Return the records of the archive in path, a list of
+  (key,segment,offset,length) with key a revision number or 't'."""
+  records=[]
+  if not os.path.exists(index_file(path)):
+    return records
+  for line in open(index_file(path)):
+    key,segment,offset,length=line.split()
+    if key!='t':
+      key=int(key)
+    records.append((key,int(segment),int(offset),int(length)))
+  return records
+
+def write_records(f,records):
+  f.writelines('%s %d %d %d\n' % r for r in records)
+  f.flush()
+  os.fsync(f.fileno())
+
+class archive(object):
+  """Write side of an archive, handed to gfiwriter.writer as tee."""
+
+  def __init__(self,path):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path=path
+    self.segment=None
+    self.name=max([-1]+[r[1] for r in read_index(path)])
+    # [key,segment,offset,length] of the part being written
+    self.record=None
+    # records written since the last flush()
+    self.pending=[]
+
+  def begin(self,key):
+    """Start the part of the stream of revision key, or 't'."""
+    self.end()
+    if self.segment==None or self.offset>=cfg_segment_size:
+      self.next_segment()
+    self.record=[key,self.name,self.offset,0]
+
+  def end(self):
+    if self.record!=None:
+      if self.record[3]>0:
+        self.pending.append(tuple(self.record))
+      self.record=None
+
+  def next_segment(self):
+    if self.segment!=None:
+      self.flush()
+      self.segment.close()
+    self.name+=1
+    self.segment=gzip.GzipFile(segment_file(self.path,self.name),'wb')
+    self.offset=0
+
+  def write(self,pieces):
+    if self.record==None:
+      self.begin('t')
+    n=0
+    for p in pieces:
+      self.segment.write(p)
+      n+=len(p)
+    self.offset+=n
+    self.record[3]+=n
+
+  def flush(self):
+    """Make the stream written so far durable and index it."""
+    record=self.record
+    self.end()
+    if self.segment!=None:
+      self.segment.flush()
+      os.fsync(self.segment.fileobj.fileno())
+    if self.pending:
+      f=open(index_file(self.path),'a')
+      write_records(f,self.pending)
+      f.close()
+      self.pending=[]
+    if record!=None:
+      # carry on with the same part in a new record
+      self.record=[record[0],self.name,self.offset,0]
+
+  def close(self):
+    self.flush()
+    self.end()
+    if self.segment!=None:
+      self.segment.close()
+      self.segment=None
+
+class segment_reader(object):
+  """Sequential reader of segments that reopens one only to go back."""
+
+  def __init__(self,path):
+    self.path=path
+    self.name=None
+
+  def open(self,name):
+    self.name=name
+    self.f=open(segment_file(self.path,name),'rb')
+    # gzip format, tolerating a segment cut short by a crash
+    self.z=zlib.decompressobj(16+zlib.MAX_WBITS)
+    self.buf=''
+    self.pos=0
+
+  def read(self,n):
+    """Return the next up to n bytes of the segment."""
+    while len(self.buf)<n:
+      d=self.f.read(cfg_read_size)
+      if d=='':
+        break
+      self.buf+=self.z.decompress(d)
+    d,self.buf=self.buf[:n],self.buf[n:]
+    self.pos+=len(d)
+    return d
+
+  def copy(self,name,offset,length,out):
+    """Write length bytes of segment name from offset on to out."""
+    if name!=self.name or offset<self.pos:
+      self.open(name)
+    while self.pos<offset:
+      if self.read(min(offset-self.pos,cfg_read_size))=='':
+        raise IOError('segment %d ends before offset %d' % (name,offset))
+    while length>0:
+      d=self.read(min(length,cfg_read_size))
+      if d=='':
+        raise IOError('segment %d ends before offset %d' % (name,offset+length))
+      out.write(d)
+      length-=len(d)
+
+def replay(path,out,first=None,last=None):
+  """Write the stream of the archive in path to the gfiwriter out, only
+  that of revisions first..last if either is given. Return the number
+  of parts written."""
+  records=read_index(path)
+  if first!=None or last!=None:
+    records=[r for r in records if r[0]!='t' and
+        (first==None or r[0]>=first) and (last==None or r[0]<=last)]
+  reader=segment_reader(path)
+  prev=None
+  for key,segment,offset,length in records:
+    if prev!=None and segment!=prev:
+      # a later run refers to commits of earlier ones by SHA1, which
+      # git-fast-import only finds once they are checkpointed
+      out.line('checkpoint')
+      out.line()
+    prev=segment
+    reader.copy(segment,offset,length,out)
+  return len(records)
+
+if __name__=='__main__':
+  usage='''%prog [options] ARCHIVE COMMAND
+
+Commands:
+  replay  Write the archived stream, or that of the revisions given
+          with -r, to stdout or to git-fast-import
+  list    Print the revision ranges in the archive'''
+  parser=OptionParser(usage=usage)
+  parser.add_option("-r","--revisions",dest="revisions",metavar="FIRST[:LAST]",
+      help="Only replay revisions FIRST to LAST")
+  parser.add_option("--fast-import",dest="fast_import",
+      help="Feed a git-fast-import child started with the options FAST_IMPORT "
+        "(may be \"\") instead of writing to stdout")
+
+  (options,args)=parser.parse_args()
+
+  if len(args)!=2:
+    parser.print_help()
+    sys.exit(2)
+
+  path,cmd=args
+  if cmd=='replay':
+    first,last=None,None
+    if options.revisions!=None:
+      r=options.revisions.split(':',1)
+      first=int(r[0])
+      if len(r)==2 and r[1]!='':
+        last=int(r[1])
+    out=gfiwriter.writer(fast_import=options.fast_import)
+    n=replay(path,out,first,last)
+    sys.stderr.write('Replayed %d parts of the stream\n' % n)
+    sys.exit(out.close() and 1 or 0)
+  elif cmd=='list':
+    revs=sorted(set(r[0] for r in read_index(path) if r[0]!='t'))
+    start=0
+    for i in xrange(len(revs)):
+      if i+1==len(revs) or revs[i+1]!=revs[i]+1:
+        print '%d:%d' % (revs[start],revs[i])
+        start=i+1
+  else:
+    parser.print_help()
+    sys.exit(2)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007, 2008 Rocco Rutte <pdmef@gmx.net> and others.
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""The ':key value' text files hg-fast-export.py and svn-fast-export.py
+keep their marks, mappings and state in. Needs nothing but Python."""
+
+import os
+import sys
+
+def mangle_key(key):
+  return key
+
+def load_cache(filename,get_key=mangle_key,get_value=mangle_key):
+  cache={}
+  if filename==None or not os.path.exists(filename):
+    return cache
+  f=open(filename,'r')
+  l=0
+  for line in f.readlines():
+    l+=1
+    fields=line.split(' ')
+    if fields==None or not len(fields)==2 or fields[0][0]!=':':
+      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l))
+      continue
+    # put key:value in cache, key without ^:
+    cache[get_key(fields[0][1:])]=get_value(fields[1].split('\n')[0])
+  f.close()
+  return cache
+
+def save_cache(filename,cache):
+  # write to a temporary file first so an interrupted save can't leave
+  # a truncated cache behind
+  f=open(filename+'.tmp','w+')
+  map(lambda x: f.write(':%s %s\n' % (str(x),str(cache.get(x)))),cache.keys())
+  f.flush()
+  os.fsync(f.fileno())
+  f.close()
+  os.rename(filename+'.tmp',filename)
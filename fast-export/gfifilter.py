@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Rewrite the history of a git repository in one pass from git
+fast-export to git-fast-import, the way hg-fast-export.py rewrites while
+converting: relocating paths, leaving parts of the tree out and
+transforming the contents of text files. Commits left empty can be
+dropped like git filter-branch --prune-empty does.
+
+git fast-export runs with --no-data and blobs are referenced by their
+SHA1, so the rewritten history has to go into a repository that has the
+original objects, like the one rewritten in place. Only a blob to be
+transformed is read, through a single git cat-file --batch, once a
+commit refers to it under a path that is exported. It is transformed
+once for every path it appears under and written once for every new
+content, by its new SHA1.
+
+A commit with one parent is empty if its changes leave the rewritten
+tree of that parent as it is. As every path is rewritten on its own,
+this is decided from the changed paths alone, by comparing each with
+the same path in the original parent's tree.
+
+The rewriting rules are those of hg-fast-export.py, see gfirewrite.py."""
+
+from gfirewrite import cfg_blob_mark_base,is_binary,load_transform
+from gfirewrite import parse_path_map,path_rules
+from optparse import OptionParser
+import gfiwriter
+import hashlib
+import subprocess
+import sys
+
+# progress is reported every this many commits
+cfg_progress_every=1000
+
+def unquote(path):
+  """Undo the C-style quoting of a path in a fast-import stream."""
+  if path.startswith('"'):
+    return path[1:-1].decode('string_escape')
+  return path
+
+def quote(path):
+  """Quote path for a fast-import stream if it has to be."""
+  if path.startswith('"') or '\n' in path:
+    return '"%s"' % path.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+  return path
+
+def git_sha1(d):
+  return hashlib.sha1('blob %d\0%s' % (len(d),d)).hexdigest()
+
+class catfile(object):
+  """Objects of the repository read through git cat-file --batch."""
+
+  def __init__(self):
+    self.child=subprocess.Popen(['git','cat-file','--batch'],
+        stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+
+  def read(self,name):
+    """Return the (type,data) of object name or None if it is missing."""
+    self.child.stdin.write(name+'\n')
+    self.child.stdin.flush()
+    header=self.child.stdout.readline().split()
+    if len(header)!=3:
+      return None
+    d=self.child.stdout.read(int(header[2]))
+    self.child.stdout.read(1)
+    return header[1],d
+
+  def entry(self,commit,path):
+    """Return the (mode,sha1) of path in commit or None."""
+    if '/' in path:
+      tree,name='%s:%s' % (commit,path.rsplit('/',1)[0]),path.rsplit('/',1)[1]
+    else:
+      tree,name='%s^{tree}' % commit,path
+    obj=self.read(tree)
+    if obj==None or obj[0]!='tree':
+      return None
+    d=obj[1]
+    pos=0
+    while pos<len(d):
+      sp=d.index(' ',pos)
+      nul=d.index('\0',sp)
+      if d[sp+1:nul]==name:
+        return d[pos:sp].rjust(6,'0'),d[nul+1:nul+21].encode('hex_codec')
+      pos=nul+21
+    return None
+
+  def close(self):
+    self.child.stdin.close()
+    return self.child.wait()
+
+class reader(object):
+  """Lines and data of a git fast-export stream, with one line of
+  look-ahead."""
+
+  def __init__(self,f):
+    self.f=f
+    self.pushed=None
+
+  def line(self):
+    """Return the next line without its LF, or None at the end."""
+    if self.pushed!=None:
+      l,self.pushed=self.pushed,None
+      return l
+    l=self.f.readline()
+    if l=='':
+      return None
+    return l[:-1]
+
+  def push(self,l):
+    """Have line() return l again."""
+    self.pushed=l
+
+  def data(self,header):
+    """Read the payload of the data command header."""
+    if not header.startswith('data ') or header.startswith('data <<'):
+      raise ValueError('expected data of a known length, got %s' % header)
+    return self.f.read(int(header[5:]))
+
+class rewriter(object):
+  def __init__(self,out,paths=None,transforms=[],prune_empty=False):
+    self.out=out
+    self.paths=paths or path_rules()
+    self.transforms=transforms
+    self.prune_empty=prune_empty
+    self.objects=catfile()
+    # (sha1,path) to (ref,new sha1) of transformed blobs
+    self.blobs={}
+    # new sha1 to the mark of the blob written with that content
+    self.written={}
+    self.next_mark=cfg_blob_mark_base+1
+    # mark of a pruned commit to the ref of the commit it became
+    self.alias={}
+    # mark of a commit to its original sha1
+    self.original={}
+    # refs whose last commit was pruned to the commit they point to now
+    self.resets={}
+    self.counters={'commits':0,'pruned':0,'blobs':0}
+
+  def transformed(self,mode):
+    """Tell if the contents of files of mode are transformed: only those
+    of regular files are."""
+    return self.transforms and mode not in ('120000','160000')
+
+  def blob_ref(self,mode,sha1,path):
+    """Return the (ref,sha1) of the rewritten blob sha1 at the new path,
+    writing the blob if its new content isn't in the repository yet.
+    Blobs that aren't transformed are referenced as they are."""
+    if not self.transformed(mode):
+      return sha1,sha1
+    key=(sha1,path)
+    r=self.blobs.get(key)
+    if r==None:
+      obj=self.objects.read(sha1)
+      if obj==None:
+        raise ValueError('blob %s of %s is missing' % (sha1,path))
+      d=obj[1]
+      if not is_binary(d):
+        for f in self.transforms:
+          d=f(path,d)
+      new=git_sha1(d)
+      if new==sha1:
+        r=sha1,sha1
+      else:
+        mark=self.written.get(new)
+        if mark==None:
+          mark=self.written[new]=self.next_mark
+          self.next_mark+=1
+          self.out.blob(mark,d)
+          self.counters['blobs']+=1
+        r=':%d' % mark,new
+      self.blobs[key]=r
+    return r
+
+  def resolve(self,ref):
+    return self.alias.get(ref,ref)
+
+  def original_commit(self,ref):
+    """The original sha1 of the commit ref, a mark or a sha1."""
+    return self.original.get(ref,ref)
+
+  def unchanged(self,parent,changes):
+    """Tell if the changes, (mode,sha1,path,new path) or (None,None,path,
+    new path) for deletions, leave the rewritten tree of the original
+    commit parent as it is."""
+    for mode,sha1,path,new in changes:
+      if mode==None or '\n' in path:
+        return False
+      entry=self.objects.entry(parent,path)
+      if entry==(mode,sha1):
+        continue
+      if entry==None or entry[0]!=mode or not self.transformed(mode):
+        return False
+      if self.blob_ref(mode,sha1,new)[1]!=self.blob_ref(mode,entry[1],new)[1]:
+        return False
+    return True
+
+  def commit(self,r,ref):
+    headers=[]
+    mark=None
+    original=None
+    while True:
+      l=r.line()
+      if l.startswith('data '):
+        msg=r.data(l)
+        break
+      if l.startswith('mark '):
+        mark=l[5:]
+      elif l.startswith('original-oid '):
+        original=l[13:]
+        continue
+      headers.append(l)
+    if mark!=None and original!=None:
+      self.original[mark]=original
+    parents=[]
+    lines=[]
+    changes=[]
+    while True:
+      l=r.line()
+      if l==None or l=='':
+        break
+      if l.startswith('from ') or l.startswith('merge '):
+        parents.append(l.split(' ',1)[1])
+      elif l.startswith('M '):
+        mode,sha1,path=l[2:].split(' ',2)
+        mode=mode.rjust(6,'0')
+        path=unquote(path)
+        new=self.paths.git_path(path)
+        if new==None:
+          continue
+        blob=self.blob_ref(mode,sha1,new)[0]
+        lines.append('M %s %s %s' % (mode,blob,quote(new)))
+        changes.append((mode,sha1,path,new))
+      elif l.startswith('D '):
+        path=unquote(l[2:])
+        new=self.paths.git_path(path)
+        if new==None:
+          continue
+        lines.append('D %s' % quote(new))
+        changes.append((None,None,path,new))
+      elif l=='deleteall':
+        lines.append(l)
+        changes.append((None,None,'\n',None))
+      else:
+        raise ValueError('unsupported change in commit %s: %s\n'
+            'Run git fast-export without -M and -C' % (mark,l))
+
+    if (self.prune_empty and mark!=None and len(parents)==1 and
+        self.unchanged(self.original_commit(parents[0]),changes)):
+      self.alias[mark]=self.resolve(parents[0])
+      self.resets[ref]=self.alias[mark]
+      self.counters['pruned']+=1
+      return
+
+    self.resets.pop(ref,None)
+    self.out.line('commit %s' % ref)
+    for h in headers:
+      self.out.line(h)
+    self.out.data(msg)
+    seen=set()
+    for i,p in enumerate(parents):
+      p=self.resolve(p)
+      # like git commit-tree, take a parent once
+      if p in seen:
+        continue
+      seen.add(p)
+      self.out.line('%s %s' % (i==0 and 'from' or 'merge',p))
+    for l in lines:
+      self.out.line(l)
+    self.out.line()
+    self.counters['commits']+=1
+    if self.counters['commits']%cfg_progress_every==0:
+      sys.stderr.write('Rewrote %d commits, pruned %d\n' %
+          (self.counters['commits'],self.counters['pruned']))
+
+  def rewrite(self,f):
+    """Rewrite the git fast-export stream read from f."""
+    r=reader(f)
+    while True:
+      l=r.line()
+      if l==None:
+        break
+      if l=='':
+        continue
+      cmd=l.split(' ',1)[0]
+      if cmd=='commit':
+        self.commit(r,l[7:])
+      elif cmd=='reset':
+        # the branch is set here, whatever was pruned before
+        self.resets.pop(l[6:],None)
+        self.out.line(l)
+        l=r.line()
+        if l!=None and l.startswith('from '):
+          self.out.line('from %s' % self.resolve(l[5:]))
+        elif l!=None:
+          r.push(l)
+        self.out.line()
+      elif cmd=='tag':
+        self.out.line(l)
+        while True:
+          l=r.line()
+          if l.startswith('from '):
+            l='from %s' % self.resolve(l[5:])
+          elif l.startswith('original-oid '):
+            continue
+          self.out.line(l)
+          if l.startswith('data '):
+            self.out.write(r.data(l),'\n')
+            break
+      elif cmd in ('progress','feature','option','done'):
+        self.out.line(l)
+      else:
+        raise ValueError('unsupported command %s' % l)
+    # point branches whose last commits were pruned at what they became
+    for ref,commit in sorted(self.resets.items()):
+      self.out.line('reset %s' % ref)
+      self.out.line('from %s' % commit)
+      self.out.line()
+
+  def close(self):
+    return self.objects.close()
+
+if __name__=='__main__':
+  usage='''%prog [options] REV...
+
+Rewrite the commits git fast-export writes for the revisions REV...
+(like master, or -- --all) of the repository in the current directory
+and write them to stdout, or with --fast-import to a git-fast-import
+child. The blobs of the original commits are referenced, so the stream
+only imports into a repository that has them:
+
+  %prog --prune-empty --fast-import "--force --quiet" master'''
+  parser=OptionParser(usage=usage)
+  parser.add_option("--path-map",action="append",dest="path_map",
+      default=[],metavar="OLD=NEW",
+      help="Rewrite paths starting with OLD to start with NEW instead; "
+        "may be given more than once, the rewrites are applied in order")
+  parser.add_option("--include",action="append",dest="include",
+      default=[],metavar="PATTERN",
+      help="Only keep paths matching the shell glob PATTERN (after --path-map)")
+  parser.add_option("--exclude",action="append",dest="exclude",
+      default=[],metavar="PATTERN",
+      help="Leave out paths matching the shell glob PATTERN (after --path-map)")
+  parser.add_option("--detracked",dest="detrackedfile",
+      help="Append the paths left out by --include and --exclude to DETRACKEDFILE")
+  parser.add_option("--transform",action="append",dest="transform",
+      default=[],metavar="NAME",
+      help="Pass the contents of text files through the built-in transform "
+        "NAME (strip-whitespace) or the function module:function; "
+        "may be given more than once")
+  parser.add_option("--prune-empty",action="store_true",dest="prune_empty",
+      default=False,help="Drop commits with one parent that leave its tree as it is")
+  parser.add_option("--fast-import",dest="fast_import",
+      help="Feed a git-fast-import child started with the options FAST_IMPORT "
+        "(may be \"\") instead of writing to stdout")
+  parser.disable_interspersed_args()
+  (options,args)=parser.parse_args()
+
+  if len(args)==0:
+    parser.print_help()
+    sys.exit(2)
+
+  try:
+    path_map=parse_path_map(options.path_map)
+    transforms=map(load_transform,options.transform)
+  except (ValueError,ImportError,AttributeError),e:
+    sys.stderr.write('Error: %s\n' % e)
+    sys.exit(2)
+  detracked=None
+  if options.detrackedfile!=None:
+    detracked=open(options.detrackedfile,'a')
+
+  export=subprocess.Popen(['git','fast-export','--no-data','--show-original-ids',
+      '--signed-tags=strip']+args,stdout=subprocess.PIPE,bufsize=gfiwriter.cfg_buffer_size)
+  out=gfiwriter.writer(fast_import=options.fast_import)
+  paths=path_rules(path_map,options.include,options.exclude,detracked)
+  w=rewriter(out,paths,transforms,options.prune_empty)
+  try:
+    w.rewrite(export.stdout)
+  except ValueError,e:
+    sys.stderr.write('Error: %s\n' % e)
+    export.kill()
+    sys.exit(1)
+  w.close()
+  status=export.wait()
+  if out.close()!=0:
+    status=1
+  if detracked!=None:
+    detracked.close()
+  sys.stderr.write('Rewrote %d commits, pruned %d, wrote %d blobs\n' %
+      (w.counters['commits'],w.counters['pruned'],w.counters['blobs']))
+  sys.exit(status and 1 or 0)
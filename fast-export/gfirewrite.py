@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Rewriting rules shared by hg-fast-export.py and gfifilter.py: paths
+relocated by prefix, left out by shell glob patterns, and the contents
+of text files passed through transforms. Needs nothing but Python, so
+that gfifilter.py runs without Mercurial."""
+
+import fnmatch
+import re
+
+# marks for blobs are handed out above this number so they never collide
+# with the marks of commits
+cfg_blob_mark_base=1<<30
+
+def path_matches(path,patterns):
+  """Tell if path or one of its leading directories matches one of the
+  shell glob patterns."""
+  for pattern in patterns:
+    pattern=pattern.rstrip('/')
+    d=path
+    while True:
+      if fnmatch.fnmatchcase(d,pattern):
+        return True
+      if '/' not in d:
+        break
+      d=d.rsplit('/',1)[0]
+  return False
+
+def is_binary(d):
+  """Tell if data is binary the way git diff does: by a NUL byte within
+  the first 8000 bytes."""
+  return '\0' in d[:8000]
+
+def strip_whitespace(path,d):
+  """Strip trailing whitespace from every line, except in patches."""
+  if path.endswith('.patch') or path.endswith('.diff'):
+    return d
+  return trailing_ws_re.sub('',d)
+
+trailing_ws_re=re.compile('[ \t\r\f\v]+$',re.M)
+
+# transforms that can be named with --transform
+builtin_transforms={'strip-whitespace':strip_whitespace}
+
+def load_transform(name):
+  """Return the built-in transform name or function 'module:function'."""
+  if name in builtin_transforms:
+    return builtin_transforms[name]
+  if ':' not in name:
+    raise ValueError('Unknown transform %s' % name)
+  module,function=name.split(':',1)
+  return getattr(__import__(module,fromlist=[function]),function)
+
+def parse_path_map(rules):
+  """Return the (old,new) prefix pairs of the --path-map rules OLD=NEW."""
+  path_map=[]
+  for rule in rules:
+    if '=' not in rule:
+      raise ValueError('--path-map wants OLD=NEW, got %s' % rule)
+    path_map.append(tuple(rule.split('=',1)))
+  return path_map
+
+class path_rules(object):
+  """The new paths of files, see --path-map, --include, --exclude and
+  --detracked."""
+
+  def __init__(self,path_map=[],include=[],exclude=[],detracked=None):
+    self.path_map=path_map
+    self.include=include
+    self.exclude=exclude
+    self.detracked=detracked
+    # original path to new path or None if left out
+    self.paths={}
+
+  def relocate(self,path):
+    """Rewrite path by the prefix rules of path_map. The rules are
+    applied in order, each one to the result of the ones before it."""
+    for old,new in self.path_map:
+      if path.startswith(old):
+        path=new+path[len(old):]
+    return path
+
+  def git_path(self,path):
+    """Return the new path of path, or None if it is left out."""
+    new=self.paths.get(path,False)
+    if new==False:
+      new=self.relocate(path)
+      if ((self.include and not path_matches(new,self.include)) or
+          path_matches(new,self.exclude)):
+        if self.detracked!=None:
+          self.detracked.write("rm '%s'\n" % new)
+        new=None
+      self.paths[path]=new
+    return new
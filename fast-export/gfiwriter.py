@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Buffered writer for git-fast-import streams, shared by hg-fast-export.py
+and svn-fast-export.py.
+
+Output goes through one large stdio buffer. Headers and payloads are
+handed over together as a list of pieces with writelines(), so blob data
+is never concatenated with its header into a new string. The stream can
+go to stdout or straight into a git-fast-import child process."""
+
+import os
+import shlex
+import subprocess
+import sys
+
+# size of the output buffer
+cfg_buffer_size=1<<20
+
+# commands of the git-fast-import language counted as such
+commands=('blob','commit','reset','tag','checkpoint','progress','feature',
+  'option','done','ls','cat-blob','get-mark')
+
+class writer(object):
+  def __init__(self,out=None,fast_import=None,bufsize=cfg_buffer_size,tee=None):
+    """Write to file object out, to a git-fast-import child started
+    with the option string fast_import, or else to stdout. Everything
+    written is also handed to tee.write() as a list of pieces if given."""
+    self.child=None
+    if fast_import!=None:
+      self.child=subprocess.Popen(['git','fast-import']+shlex.split(fast_import),
+          stdin=subprocess.PIPE,bufsize=bufsize)
+      out=self.child.stdin
+    elif out==None:
+      sys.stdout.flush()
+      out=os.fdopen(os.dup(sys.stdout.fileno()),'wb',bufsize)
+    self.out=out
+    self.tee=tee
+    self.counters={'bytes':0,'commands':0}
+
+  def write(self,*pieces):
+    """Write pieces of the stream as they are."""
+    self.out.writelines(pieces)
+    if self.tee!=None:
+      self.tee.write(pieces)
+    self.counters['bytes']+=sum(map(len,pieces))
+
+  def line(self,msg=''):
+    if msg.split(' ',1)[0] in commands:
+      self.counters['commands']+=1
+    self.write(msg,'\n')
+
+  def data(self,d):
+    """Write a data command with its payload."""
+    self.write('data %d\n' % len(d),d,'\n')
+
+  def blob(self,mark,d):
+    """Write a blob command with its payload."""
+    self.counters['commands']+=1
+    self.write('blob\nmark :%d\ndata %d\n' % (mark,len(d)),d,'\n')
+
+  def flush(self):
+    self.out.flush()
+
+  def close(self):
+    """Flush the stream and return the exit status of the
+    git-fast-import child, if any."""
+    self.out.close()
+    if self.child!=None:
+      return self.child.wait()
+    return 0
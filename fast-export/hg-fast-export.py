@@ -3,13 +3,29 @@
 # Copyright (c) 2007, 2008 Rocco Rutte <pdmef@gmx.net> and others.
 # License: MIT <http://www.opensource.org/licenses/mit-license.php>
 
-from mercurial import node
+from mercurial import node,mdiff
 from hg2git import setup_repo,fixup_user,get_branch,get_changeset
 from hg2git import load_cache,save_cache,get_git_sha1,set_default_branch,set_origin_name
+from hg2git import cfg_blob_mark_base,user_cache_stats
+from exportstats import export_stats,now
+import gfiwriter
+import gfiarchive
+from gfirewrite import is_binary,load_transform,parse_path_map,path_rules
+import hgstore
+import revlogmap
 from optparse import OptionParser
 import re
 import sys
 import os
+import struct
+import zlib
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import pipes
+import shutil
+import tempfile
 
 if sys.platform == "win32":
   # On Windows, sys.stdout is initially opened in text mode, which means that
@@ -21,18 +37,57 @@ if sys.platform == "win32":
 
 # silly regex to catch Signed-off-by lines in log message
 sob_re=re.compile('^Signed-[Oo]ff-[Bb]y: (.+)$')
-# insert 'checkpoint' command after this many commits or none at all if 0
+# insert 'checkpoint' command after this many commits or none at all if 0,
+# also saving our state so that an aborted export can resume from there
 cfg_checkpoint_count=0
 # write some progress message every this many file contents written
 cfg_export_boundary=1000
+# read file revisions through revlogmap instead of filectx
+cfg_bulk_read=False
+# the revlogmap.bulkreader used if cfg_bulk_read is set, set up by hg2git()
+bulk=None
+# write the blobs in this many parallel processes before the commits
+cfg_shards=0
+# keep memory flat however long the history, see --low-memory
+cfg_low_memory=False
+# in low-memory mode, drop the entries Mercurial caches from the changelog
+# and manifest indexes every this many revisions
+cfg_cache_revisions=1000
+# cross-check the changelog's file list against a full repo.status()
+cfg_check_status=False
+# number of earlier revisions checked against the mapping by --verify-mapping
+cfg_mapping_samples=100
+# file revisions larger than this many bytes are streamed in chunks
+cfg_stream_threshold=16<<20
+# size of the chunks large file revisions are streamed in
+cfg_stream_chunk=1<<20
+# number of largest blobs to report at the end of the export
+cfg_largest_blobs=10
+# abort if the exporter's address space grows beyond this many MB, see
+# limit_memory()
+cfg_memory_limit=None
+# the soft limit of the address space before limit_memory() changed it
+memory_soft_limit=None
+# (size,path,revision) of the largest blobs written so far, a heap
+largest_blobs=[]
+# phase timings and throughput, written out with --stats
+stats=export_stats()
+# the git-fast-import stream, set up by hg2git()
+out=None
+# the gfiarchive.archive the stream is also written to, see --archive
+archive=None
+# hg paths to git paths, see --path-map, --include, --exclude and --detracked
+paths=path_rules()
+# functions (path,data) -> data applied to text file contents, see --transform
+transforms=[]
 
 def gitmode(flags):
   return 'l' in flags and '120000' or 'x' in flags and '100755' or '100644'
 
 def wr(msg=''):
-  if msg:
-    sys.stdout.write(msg)
-  sys.stdout.write('\n')
+  t=now()
+  out.line(msg)
+  stats.add('write',t)
   #map(lambda x: sys.stderr.write('\t[%s]\n' % x),msg.split('\n'))
 
 def checkpoint(count):
@@ -41,47 +96,129 @@ def checkpoint(count):
     sys.stderr.write("Checkpoint after %d commits\n" % count)
     wr('checkpoint')
     wr()
+    # hand it to git-fast-import now, not when the buffer is full
+    out.flush()
   return count
 
+def drop_caches(repo):
+  """Free the parsed index entries and node lookup trees of the changelog
+  and the manifest, which otherwise grow with every revision read."""
+  repo.changelog.clearcaches()
+  repo.manifest.clearcaches()
+
+def limit_memory(on=True):
+  """Limit the exporter's address space, mmaps included, to
+  cfg_memory_limit MB, or lift the limit again with on=False. Processes
+  spawned meanwhile would inherit it, so it is only set once the git
+  commands hg2git() runs are spawned, and lifted while the workers of
+  --shards are. Only the soft limit is set, as the hard one couldn't be
+  raised again."""
+  global memory_soft_limit
+  if cfg_memory_limit==None:
+    return
+  import resource
+  soft,hard=resource.getrlimit(resource.RLIMIT_AS)
+  if memory_soft_limit==None:
+    memory_soft_limit=soft
+  if on:
+    soft=cfg_memory_limit<<20
+    if hard!=resource.RLIM_INFINITY and soft>hard:
+      soft=hard
+  else:
+    soft=memory_soft_limit
+  resource.setrlimit(resource.RLIMIT_AS,(soft,hard))
+
 def revnum_to_revref(rev, old_marks):
   """Convert an hg revnum to a git-fast-import rev reference (an SHA1
   or a mark)"""
   return old_marks.get(rev) or ':%d' % (rev+1)
 
-def file_mismatch(f1,f2):
-  """See if two revisions of a file are not equal."""
-  return node.hex(f1)!=node.hex(f2)
-
-def split_dict(dleft,dright,l=[],c=[],r=[],match=file_mismatch):
-  """Loop over our repository and find all changed and missing files."""
-  for left in dleft.keys():
-    right=dright.get(left,None)
-    if right==None:
+def manifest_changes(repo,mleft,mright):
+  """Find the files added, changed and removed in manifest node mleft
+  relative to manifest node mright.
+
+  Instead of walking every entry of both manifests, this diffs the two
+  manifest texts and only parses the lines inside the resulting hunks.
+  Nodes are compared as they are stored in the manifest text."""
+  left=repo.manifest.revision(mleft)
+  right=repo.manifest.revision(mright)
+  delta=mdiff.textdiff(right,left)
+  old,new={},{}
+  pos=0
+  while pos<len(delta):
+    start,end,length=struct.unpack('>lll',delta[pos:pos+12])
+    pos+=12
+    for line in right[start:end].splitlines():
+      f,n=line.split('\0')
+      old[f]=n[:40]
+    for line in delta[pos:pos+length].splitlines():
+      f,n=line.split('\0')
+      new[f]=n[:40]
+    pos+=length
+  l,c,r=[],[],[]
+  for f,n in new.iteritems():
+    o=old.get(f)
+    if o==None:
       # we have the file but our parent hasn't: add to left set
-      l.append(left)
-    elif match(dleft[left],right):
+      l.append(f)
+    elif o!=n:
       # we have it but checksums mismatch: add to center set
-      c.append(left)
-  for right in dright.keys():
-    left=dleft.get(right,None)
-    if left==None:
+      c.append(f)
+  for f in old:
+    if f not in new:
       # if parent has file but we don't: add to right set
-      r.append(right)
-    # change is already handled when comparing child against parent
+      r.append(f)
   return l,c,r
 
-def get_filechanges(repo,revision,parents,mleft):
-  """Given some repository and revision, find all changed/deleted files."""
+def get_filechanges(repo,mnode,parents):
+  """Given some repository and the manifest node of a revision, find all
+  files changed/deleted relative to any of the parents."""
   l,c,r=[],[],[]
   for p in parents:
     if p<0: continue
-    mright=repo.changectx(p).manifest()
-    l,c,r=split_dict(mleft,mright,l,c,r)
+    pl,pc,pr=manifest_changes(repo,mnode,repo.changelog.read(repo.changelog.node(p))[0])
+    l+=pl
+    c+=pc
+    r+=pr
   l.sort()
   c.sort()
   r.sort()
   return l,c,r
 
+class touched_manifest(dict):
+  """Filenodes and flags of only the files a revision touched, usable
+  where export_file_contents() expects a full manifest."""
+  def __init__(self):
+    dict.__init__(self)
+    self._flags={}
+  def flags(self,f):
+    return self._flags.get(f,'')
+
+def get_touched_changes(repo,files,mleft,mright):
+  """Classify the files listed in a changelog entry as added, changed
+  or removed by looking each one up in the manifests of the revision
+  (mleft) and its only parent (mright)."""
+  l,c,r=[],[],[]
+  man=touched_manifest()
+  for f in files:
+    left,lflags=repo.manifest.find(mleft,f)
+    right,rflags=repo.manifest.find(mright,f)
+    if left==None:
+      if right!=None: r.append(f)
+      continue
+    if right==None:
+      l.append(f)
+    elif left!=right or lflags!=rflags:
+      c.append(f)
+    else:
+      continue
+    man[f]=left
+    man._flags[f]=lflags
+  l.sort()
+  c.sort()
+  r.sort()
+  return l,c,r,man
+
 def get_author(logmessage,committer,authors):
   """As git distincts between author and committer of a patch, try to
   extract author by detecting Signed-off-by lines.
@@ -98,48 +235,189 @@ def get_author(logmessage,committer,authors):
   "Signed-off-by: foo" and thus matching our detection regex. Prevent
   that."""
 
-  loglines=logmessage.split('\n')
-  i=len(loglines)
-  # from tail walk to top skipping empty lines
-  while i>=0:
-    i-=1
-    if len(loglines[i].strip())==0: continue
-    break
-  if i>=0:
-    # walk further upwards to find first sob line, store in 'first'
-    first=None
-    while i>=0:
-      m=sob_re.match(loglines[i])
-      if m==None: break
-      first=m
-      i-=1
-    # if the last non-empty line matches our Signed-Off-by regex: extract username
-    if first!=None:
-      r=fixup_user(first.group(1),authors)
-      if r.find('>') < r.find('<'):
-          return "Invalid User <invalid@email.com>"
-      return r
+  # only look at the trailing lines instead of splitting the whole message
+  end=len(logmessage)
+  first=None
+  while end>=0:
+    start=logmessage.rfind('\n',0,end)+1
+    line=logmessage[start:end]
+    end=start-1
+    if first==None and len(line.strip())==0: continue
+    # walk upwards to find the first of the trailing sob lines
+    m=sob_re.match(line)
+    if m==None: break
+    first=m
+  # if the last non-empty line matches our Signed-Off-by regex: extract username
+  if first!=None:
+    r=fixup_user(first.group(1),authors)
+    if r.find('>') < r.find('<'):
+        return "Invalid User <invalid@email.com>"
+    return r
   if committer.find('>') < committer.find('<'):
       return "Invalid User <invalid@email.com>"
   return committer
 
-def export_file_contents(ctx,manifest,files):
+def read_revlog_chunks(rl,rev):
+  """Yield the text of a revlog revision stored as a full snapshot in
+  pieces of at most about cfg_stream_chunk bytes."""
+  start=rl.start(rev)
+  remaining=rl.length(rev)
+  if rl._inline:
+    f=rl.opener(rl.indexfile)
+    start+=(rev+1)*rl._io.size
+  else:
+    f=rl.opener(rl.datafile)
+  try:
+    f.seek(start)
+    def read():
+      d=f.read(min(cfg_stream_chunk,remaining))
+      return d,remaining-len(d)
+    pending,remaining=read()
+    if not pending:
+      return
+    t=pending[0]
+    if t=='u':
+      pending=pending[1:]
+    if t!='x':
+      # stored uncompressed
+      while pending:
+        yield pending
+        pending,remaining=read()
+      return
+    z=zlib.decompressobj()
+    while pending:
+      yield z.decompress(pending,cfg_stream_chunk)
+      pending=z.unconsumed_tail
+      if not pending and remaining>0:
+        pending,remaining=read()
+    yield z.flush()
+  finally:
+    f.close()
+
+def stream_file_data(fctx):
+  """Return the size of a large file revision and an iterator over its
+  data in chunks, or None if it is small or isn't a full snapshot of
+  known size that can be read piecewise straight from the revlog."""
+  fl=fctx.filelog()
+  rev=fctx.filerev()
+  rawsize=fl.index[rev][2]
+  if rawsize<=cfg_stream_threshold or fl.index[rev][3]!=rev:
+    return None
+  chunks=read_revlog_chunks(fl,rev)
+  # strip copy metadata like filelog.read() does, it comes first
+  head=''
+  for chunk in chunks:
+    head+=chunk
+    if len(head)>=2 and (head[:2]!='\1\n' or head.find('\1\n',2)>=0):
+      break
+  skip=0
+  if head[:2]=='\1\n':
+    skip=head.index('\1\n',2)+2
+  def data():
+    yield head[skip:]
+    for chunk in chunks:
+      yield chunk
+  return rawsize-skip,data()
+
+def transform_data(path,d):
+  for transform in transforms:
+    d=transform(path,d)
+  return d
+
+def blob_key(filenode,path,transform):
+  """Return the key blob_marks and blob_refs know the blob of a file
+  revision by: its hex filenode, or if its contents are transformed, the
+  hex sha1 of filenode and git path, since transforms may depend on the
+  path and files of identical contents share a filenode."""
+  if not transform:
+    return node.hex(filenode)
+  return hashlib.sha1(filenode+path).hexdigest()
+
+def binary_stream(streamed):
+  """Return a streamed file revision unchanged if it is binary, or None
+  if it has to be read as a whole to be transformed."""
+  size,chunks=streamed
+  head=next(chunks,'')
+  if not is_binary(head):
+    return None
+  return size,itertools.chain([head],chunks)
+
+def note_blob_size(size,file,revision):
+  if len(largest_blobs)<cfg_largest_blobs:
+    heapq.heappush(largest_blobs,(size,file,revision))
+  elif size>largest_blobs[0][0]:
+    heapq.heapreplace(largest_blobs,(size,file,revision))
+
+def export_file_contents(ctx,manifest,files,blob_marks,blob_refs):
+  """Write a blob for every file revision git-fast-import doesn't know yet
+  and return the filemodify lines referencing them.
+
+  Blobs are keyed by their hg filenode, see blob_key(), so that a file
+  revision which reappears (backouts, merges, copies) is only read,
+  transformed and sent once."""
   count=0
   max=len(files)
+  lines=[]
   for file in files:
     # Skip .hgtags files. They only get us in trouble.
     if file == ".hgtags":
       sys.stderr.write('Skip %s\n' % (file))
       continue
-    d=ctx.filectx(file).data()
-    wr('M %s inline %s' % (gitmode(manifest.flags(file)),file))
-    wr('data %d' % len(d)) # had some trouble with size()
-    wr(d)
-    count+=1
-    if count%cfg_export_boundary==0:
-      sys.stderr.write('Exported %d/%d files\n' % (count,max))
+    # don't even read what isn't exported
+    path=paths.git_path(file)
+    if path==None:
+      stats.count('excluded')
+      continue
+    # only the contents of regular text files are transformed
+    transform=transforms and 'l' not in manifest.flags(file)
+    key=blob_key(manifest[file],path,transform)
+    ref=blob_refs.get(key)
+    if ref==None:
+      # re-use the mark of a blob whose sha1 didn't make it into the marks file
+      mark=blob_marks.get(key,cfg_blob_mark_base+len(blob_marks)+1)
+      fctx=None
+      streamed=None
+      if bulk==None or not 0<=bulk.rawsize(file,manifest[file])<=cfg_stream_threshold:
+        fctx=ctx.filectx(file)
+        streamed=stream_file_data(fctx)
+        if streamed!=None and transform:
+          streamed=binary_stream(streamed)
+      if streamed!=None:
+        # don't keep large file revisions in memory as a whole
+        size,chunks=streamed
+        wr('blob')
+        wr('mark :%d' % mark)
+        wr('data %d' % size)
+        t=now()
+        for chunk in chunks:
+          t=stats.add('blob_read',t)
+          out.write(chunk)
+          t=stats.add('write',t)
+        wr()
+      else:
+        t=now()
+        if fctx==None:
+          d=bulk.read(file,manifest[file])
+        else:
+          d=fctx.data()
+        t=stats.add('blob_read',t)
+        if transform and not is_binary(d):
+          d=transform_data(path,d)
+          t=stats.add('transform',t)
+        size=len(d) # had some trouble with size()
+        out.blob(mark,d)
+        stats.add('write',t)
+      note_blob_size(size,file,ctx.rev())
+      stats.count('blobs')
+      blob_marks[key]=mark
+      ref=blob_refs[key]=':%d' % mark
+      count+=1
+      if count%cfg_export_boundary==0:
+        sys.stderr.write('Exported %d/%d files\n' % (count,max))
+    lines.append('M %s %s %s' % (gitmode(manifest.flags(file)),ref,path))
   if max>cfg_export_boundary:
     sys.stderr.write('Exported %d/%d files\n' % (count,max))
+  return lines
 
 def sanitize_name(name,what="branch"):
   """Sanitize input roughly according to git-check-ref-format(1)"""
@@ -160,7 +438,53 @@ def sanitize_name(name,what="branch"):
     sys.stderr.write('Warning: sanitized %s [%s] to [%s]\n' % (what,name,n))
   return n
 
-def export_commit(ui,repo,revision,old_marks,max,count,authors,sob,brmap):
+def revision_changes(repo,revision,ctx,revnode,mnode,files):
+  """Return the sorted parents of a revision, its added, changed and
+  removed files, a manifest holding at least the added and changed ones
+  and a description of how they were found."""
+  parents = [p for p in repo.changelog.parentrevs(revision) if p >= 0]
+
+  # Sort the parents based on revision ids so that we always get the
+  # same resulting git repo, no matter how the revisions were
+  # numbered.
+  parents.sort(key=repo.changelog.node, reverse=True)
+
+  added,changed,removed,type=[],[],[],''
+
+  if len(parents) == 0:
+    # first revision: feed in full manifest
+    man=ctx.manifest()
+    added=man.keys()
+    added.sort()
+    type='full'
+  elif len(parents) == 1:
+    # later non-merge revision: feed in changed manifest
+    # if we have exactly one parent, the changelog entry already names
+    # every touched file so only look those up in both manifests
+    pnode=repo.changelog.node(parents[0])
+    added,changed,removed,man=get_touched_changes(repo,files,mnode,
+        repo.changelog.read(pnode)[0])
+    type='simple delta'
+    if cfg_check_status:
+      f=repo.status(pnode,revnode)[:3]
+      if (f[1],f[0],f[2])!=(added,changed,removed):
+        sys.stderr.write('Warning: changelog file list of r%d disagrees with'
+            ' status, using status\n' % revision)
+        added,changed,removed=f[1],f[0],f[2]
+        man=ctx.manifest()
+  else: # a merge with two parents
+    # later merge revision: feed in changed manifest
+    # for many files comparing checksums is expensive so only do it for
+    # merges where we really need it due to hg's revlog logic
+    added,changed,removed=get_filechanges(repo,mnode,parents)
+    man=touched_manifest()
+    for f in added+changed:
+      man[f],man._flags[f]=repo.manifest.find(mnode,f)
+    type='thorough delta'
+
+  return parents,added,changed,removed,man,type
+
+def export_commit(ui,repo,revision,old_marks,max,count,authors,sob,brmap,blob_marks,blob_refs):
   def get_branchname(name):
     if brmap.has_key(name):
       return brmap[name]
@@ -168,15 +492,30 @@ def export_commit(ui,repo,revision,old_marks,max,count,authors,sob,brmap):
     brmap[name]=n
     return n
 
-  (revnode,_,user,(time,timezone),files,desc,branch,_)=get_changeset(ui,repo,revision,authors)
+  start=now()
+  if archive!=None:
+    archive.begin(revision)
+  (revnode,mnode,user,(time,timezone),files,desc,branch,_)=get_changeset(ui,repo,revision,authors)
+  t=stats.add('changelog',start)
   if user.find("<at>")!=-1:
       user = "Evil Email <malformatted@us.er>"
 
   branch=get_branchname(branch)
 
-  parents = [p for p in repo.changelog.parentrevs(revision) if p >= 0]
+  ctx=repo.changectx(str(revision))
+  parents,added,changed,removed,man,type=revision_changes(repo,revision,
+      ctx,revnode,mnode,files)
+
+  stats.add('diff',t)
 
-  if len(parents)==0 and revision != 0:
+  sys.stderr.write('%s: Exporting %s revision %d/%d with %d/%d/%d added/changed/removed files\n' %
+      (branch,type,revision+1,max,len(added),len(changed),len(removed)))
+
+  # blobs have to be sent before the commit referencing them
+  modified=export_file_contents(ctx,man,added,blob_marks,blob_refs)
+  modified+=export_file_contents(ctx,man,changed,blob_marks,blob_refs)
+
+  if len(parents)==0:
     wr('reset refs/heads/%s' % branch)
 
   wr('commit refs/heads/%s' % branch)
@@ -188,46 +527,18 @@ def export_commit(ui,repo,revision,old_marks,max,count,authors,sob,brmap):
   wr(desc)
   wr()
 
-
-  # Sort the parents based on revision ids so that we always get the
-  # same resulting git repo, no matter how the revisions were
-  # numbered.
-  parents.sort(key=repo.changelog.node, reverse=True)
-
-  ctx=repo.changectx(str(revision))
-  man=ctx.manifest()
-  added,changed,removed,type=[],[],[],''
-
-  if len(parents) == 0:
-    # first revision: feed in full manifest
-    added=man.keys()
-    added.sort()
-    type='full'
-  else:
+  if len(parents) > 0:
     wr('from %s' % revnum_to_revref(parents[0], old_marks))
-    if len(parents) == 1:
-      # later non-merge revision: feed in changed manifest
-      # if we have exactly one parent, just take the changes from the
-      # manifest without expensively comparing checksums
-      f=repo.status(repo.lookup(parents[0]),revnode)[:3]
-      added,changed,removed=f[1],f[0],f[2]
-      type='simple delta'
-    else: # a merge with two parents
-      wr('merge %s' % revnum_to_revref(parents[1], old_marks))
-      # later merge revision: feed in changed manifest
-      # for many files comparing checksums is expensive so only do it for
-      # merges where we really need it due to hg's revlog logic
-      added,changed,removed=get_filechanges(repo,revision,parents,man)
-      type='thorough delta'
+  if len(parents) > 1:
+    wr('merge %s' % revnum_to_revref(parents[1], old_marks))
 
-  sys.stderr.write('%s: Exporting %s revision %d/%d with %d/%d/%d added/changed/removed files\n' %
-      (branch,type,revision+1,max,len(added),len(changed),len(removed)))
-
-  map(lambda r: wr('D %s' % r),removed)
-  export_file_contents(ctx,man,added)
-  export_file_contents(ctx,man,changed)
+  for path in map(paths.git_path,removed):
+    if path!=None:
+      wr('D %s' % path)
+  map(wr,modified)
   wr()
 
+  stats.revision(revision,start)
   return checkpoint(count)
 
 def export_tags(ui,repo,old_marks,mapping_cache,count,authors):
@@ -291,59 +602,254 @@ def verify_heads(ui,repo,cache,force):
 
   # verify that branch has exactly one head
   t={}
-  for h in repo.heads():
+  for h in sorted(repo.changelog.headrevs(),reverse=True):
     (_,_,_,_,_,_,branch,_)=get_changeset(ui,repo,h)
     if t.get(branch,False):
-      sys.stderr.write('Error: repository has at least one unnamed head: hg r%s\n' %
-          repo.changelog.rev(h))
+      sys.stderr.write('Error: repository has at least one unnamed head: hg r%s\n' % h)
       if not force: return False
     t[branch]=True
 
   return True
 
-def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,authors={},sob=False,force=False):
+def update_mapping(repo,mapping_cache,min,max,verify=False):
+  """Extend the hg-to-git mapping by the revisions min..max-1.
+
+  Revisions below min are taken from the last run's mapping. If it
+  can't cover them, or if verify is set and one of a sample of them
+  doesn't match the repository, the mapping is rebuilt from scratch."""
+  start=min
+  if len(mapping_cache)<min:
+    sys.stderr.write('Mapping has %d of %d revisions, rebuilding\n' %
+        (len(mapping_cache),min))
+    start=0
+  elif verify and min>0:
+    step=min/cfg_mapping_samples or 1
+    for rev in range(min-1,-1,-step):
+      if mapping_cache.get(node.hex(repo.changelog.node(rev)))!=str(rev):
+        sys.stderr.write('Mapping disagrees with repository at r%d, rebuilding\n' % rev)
+        start=0
+        break
+  if start==0:
+    mapping_cache.clear()
+  for rev in xrange(start,max):
+    mapping_cache[node.hex(repo.changelog.node(rev))]=str(rev)
+    if cfg_low_memory and (rev+1)%cfg_cache_revisions==0:
+      drop_caches(repo)
+
+class shard_refs(object):
+  """blob_refs of a shard worker. Blobs of earlier runs are looked up in
+  the exporter's blob_refs, blobs written by the worker are only kept
+  here so that the exporter's store isn't touched."""
+  def __init__(self,refs):
+    self.refs=refs
+    self.written={}
+  def get(self,k,default=None):
+    v=self.written.get(k)
+    if v==None:
+      v=self.refs.get(k)
+    if v==None:
+      return default
+    return v
+  def __setitem__(self,k,v):
+    self.written[k]=v
+
+def export_shard_blobs(repourl,first,last,blob_refs,marksfile,blobsfile):
+  """Write the blobs of revisions first..last-1 to a git-fast-import of
+  their own, which exports its marks to marksfile, and save the hg
+  filenodes of the blobs with their marks to blobsfile."""
+  global out
+  stats.out=None
+  out=gfiwriter.writer(fast_import='--quiet --export-marks=%s' % pipes.quote(marksfile))
+  limit_memory()
+  ui,repo=setup_repo(repourl)
+  blob_marks={}
+  refs=shard_refs(blob_refs)
+  for rev in xrange(first,last):
+    (revnode,mnode,_,_,files,_,_,_)=get_changeset(ui,repo,rev)
+    ctx=repo.changectx(str(rev))
+    _,added,changed,_,man,_=revision_changes(repo,rev,ctx,revnode,mnode,files)
+    export_file_contents(ctx,man,added+changed,blob_marks,refs)
+  status=out.close()
+  save_cache(blobsfile,blob_marks)
+  sys.exit(status)
+
+def export_shards(repourl,start,end,shards,blob_marks,blob_refs,shard_marks):
+  """Write the blobs of revisions start..end-1 from up to shards worker
+  processes in parallel, each one into a git-fast-import of its own,
+  and enter them into blob_refs by their sha1 so that the commits can
+  then be written in order referencing them. Each blob is given a mark
+  of the exporter in blob_marks and its sha1 is entered into shard_marks
+  by that mark, so that incremental runs know it like any blob. Return
+  False if a worker failed."""
+  size=(end-start+shards-1)/shards
+  tmp=tempfile.mkdtemp(prefix='hg2git-shards.')
+  # forked workers must not inherit anything still to be written, nor the
+  # memory limit before they have spawned their git-fast-import
+  out.flush()
+  limit_memory(False)
+  try:
+    workers=[]
+    for first in xrange(start,end,size):
+      last=first+size<end and first+size or end
+      marksfile=os.path.join(tmp,'marks-%d' % first)
+      blobsfile=os.path.join(tmp,'blobs-%d' % first)
+      sys.stderr.write('Exporting blobs of revisions %d-%d in a worker\n' % (first,last-1))
+      w=multiprocessing.Process(target=export_shard_blobs,
+          args=(repourl,first,last,blob_refs,marksfile,blobsfile))
+      w.start()
+      workers.append((w,first,last,marksfile,blobsfile))
+    limit_memory()
+    ok=True
+    for w,first,last,marksfile,blobsfile in workers:
+      w.join()
+      if w.exitcode!=0:
+        sys.stderr.write('Error: worker for revisions %d-%d failed\n' % (first,last-1))
+        ok=False
+        continue
+      marks=load_cache(marksfile)
+      blobs=load_cache(blobsfile)
+      for key,mark in blobs.iteritems():
+        sha1=marks[mark]
+        if blob_refs.get(key)==sha1:
+          # also written by an earlier worker
+          continue
+        mark=blob_marks.get(key,cfg_blob_mark_base+len(blob_marks)+1)
+        blob_marks[key]=mark
+        blob_refs[key]=sha1
+        shard_marks[mark]=sha1
+      stats.count('blobs',len(blobs))
+    return ok
+  finally:
+    shutil.rmtree(tmp)
+
+def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,authors={},sob=False,force=False,blobsfile=None,verify_mapping=False,storedir=None,statsfile=None,
+    fast_import=None,archivedir=None):
+  global out,bulk,archive
   _max=int(m)
 
-  old_marks=load_cache(marksfile,lambda s: int(s)-1)
-  mapping_cache=load_cache(mappingfile)
-  heads_cache=load_cache(headsfile)
-  state_cache=load_cache(tipfile)
+  if archivedir!=None:
+    archive=gfiarchive.archive(archivedir)
+  out=gfiwriter.writer(fast_import=fast_import,tee=archive)
+  stats.watch('',out.counters)
+
+  if statsfile!=None:
+    stats.out=open(statsfile,'w')
+  stats.watch('user_cache_',user_cache_stats)
+
+  store=None
+  if storedir!=None:
+    store=hgstore.store(storedir,low_memory=cfg_low_memory)
+    old_marks=store.marks()
+    mapping_cache=store.mapping()
+    heads_cache=store.heads
+    state_cache=store.state
+    blob_marks=store.blob_marks()
+    blob_refs=store.blob_refs()
+  else:
+    old_marks=load_cache(marksfile,lambda s: int(s)-1)
+    mapping_cache=load_cache(mappingfile)
+    heads_cache=load_cache(headsfile)
+    state_cache=load_cache(tipfile)
+    blob_marks={}
+    if blobsfile!=None:
+      blob_marks=load_cache(blobsfile,get_value=int)
+    # blobs of earlier runs can only be referenced by the sha1 they got
+    blob_refs={}
+    for filenode,mark in blob_marks.items():
+      sha1=old_marks.get(mark-1)
+      if sha1!=None: blob_refs[filenode]=sha1
 
   ui,repo=setup_repo(repourl)
+  if cfg_bulk_read:
+    bulk=revlogmap.bulkreader(repo)
 
   if not verify_heads(ui,repo,heads_cache,force):
     return 1
+  # git-fast-import and git-for-each-ref have been spawned by now
+  limit_memory()
 
-  try:
-    tip=repo.changelog.count()
-  except AttributeError:
-    tip=len(repo)
+  tip=len(repo.changelog)
 
   min=int(state_cache.get('tip',0))
+  # an export may have died before git-fast-import made its last commits
+  # durable: resume after the last one it has written a mark for
+  while min>0 and old_marks.get(min-1)==None:
+    min-=1
+  if min<int(state_cache.get('tip',0)):
+    sys.stderr.write('Resuming after last imported revision %d\n' % min)
   max=_max
   if _max<0 or max>tip:
     max=tip
 
-  for rev in range(0,max):
-  	(revnode,_,_,_,_,_,_,_)=get_changeset(ui,repo,rev,authors)
-  	mapping_cache[revnode.encode('hex_codec')] = str(rev)
-
+  update_mapping(repo,mapping_cache,min,max,verify_mapping)
+  if cfg_low_memory:
+    drop_caches(repo)
+
+  def save_state(tip):
+    state_cache['tip']=tip
+    state_cache['repo']=repourl
+    if archive!=None:
+      archive.flush()
+    if store!=None:
+      store.save()
+    else:
+      save_cache(tipfile,state_cache)
+      save_cache(mappingfile,mapping_cache)
+      if blobsfile!=None:
+        save_cache(blobsfile,blob_marks)
+
+  if cfg_checkpoint_count>0:
+    # record the repository right away so a resumed run can find it
+    save_state(min)
+
+  if cfg_shards>1 and max-min>1:
+    shard_marks={}
+    ok=export_shards(repourl,min,max,cfg_shards,blob_marks,blob_refs,shard_marks)
+    # the exporter's git-fast-import doesn't know the sha1s of the shards'
+    # blobs, so record them along with the marks it exports
+    if store!=None:
+      store.set_marks(shard_marks)
+    else:
+      f=open(marksfile,'a')
+      for mark,sha1 in sorted(shard_marks.iteritems()):
+        f.write(':%d %s\n' % (mark,sha1))
+      f.close()
+    if not ok:
+      return 1
 
   c=0
   brmap={}
-  for rev in range(min,max):
-    c=export_commit(ui,repo,rev,old_marks,max,c,authors,sob,brmap)
-
-  state_cache['tip']=max
-  state_cache['repo']=repourl
-  save_cache(tipfile,state_cache)
-  save_cache(mappingfile,mapping_cache)
-
+  for rev in xrange(min,max):
+    c=export_commit(ui,repo,rev,old_marks,max,c,authors,sob,brmap,blob_marks,blob_refs)
+    if cfg_low_memory and (rev+1)%cfg_cache_revisions==0:
+      drop_caches(repo)
+      store.unmap()
+    if cfg_checkpoint_count>0 and c%cfg_checkpoint_count==0:
+      # git-fast-import dumps its marks on checkpoint, so save along
+      save_state(rev+1)
+
+  save_state(max)
+
+  if archive!=None:
+    archive.begin('t')
   c=export_tags(ui,repo,old_marks,mapping_cache,c,authors)
+  if store!=None:
+    store.close()
+  if bulk!=None:
+    bulk.close()
+
+  if largest_blobs:
+    sys.stderr.write('Largest blobs:\n')
+    for size,file,rev in sorted(largest_blobs,reverse=True):
+      sys.stderr.write('  %d bytes: %s (hg r%d)\n' % (size,file,rev))
 
   sys.stderr.write('Issued %d commands\n' % c)
+  status=out.close()
+  if archive!=None:
+    archive.close()
+  stats.emit(final=True)
 
-  return 0
+  return status and 1 or 0
 
 if __name__=='__main__':
   def bail(parser,opt):
@@ -359,8 +865,14 @@ if __name__=='__main__':
       help="File to read last run's hg-to-git SHA1 mapping")
   parser.add_option("--marks",dest="marksfile",
       help="File to read git-fast-import's marks from")
+  parser.add_option("--blobs",dest="blobsfile",
+      help="File to read last run's hg filenode to blob mark mapping")
   parser.add_option("--heads",dest="headsfile",
       help="File to read last run's git heads from")
+  parser.add_option("--store-dir",dest="storedir",
+      help="Use the binary store in STOREDIR instead of the text files")
+  parser.add_option("--store",action="store_true",dest="store",default=False,
+      help="Use the binary store given with --store-dir, as hg-fast-export.sh does")
   parser.add_option("--status",dest="statusfile",
       help="File to read status from")
   parser.add_option("-r","--repo",dest="repourl",
@@ -375,16 +887,59 @@ if __name__=='__main__':
       help="Set the default branch")
   parser.add_option("-o","--origin",dest="origin_name",
       help="use <name> as namespace to track upstream")
+  parser.add_option("--verify-mapping",action="store_true",dest="verify_mapping",
+      default=False,help="Check a sample of the last run's hg-to-git mapping")
+  parser.add_option("--stats",dest="statsfile",
+      help="Write per-phase timings and throughput as JSON lines to STATSFILE")
+  parser.add_option("--fast-import",dest="fast_import",
+      help="Feed a git-fast-import child started with the options FAST_IMPORT "
+        "(may be \"\") instead of writing to stdout")
+  parser.add_option("--checkpoint",type="int",dest="checkpoint",
+      help="Checkpoint git-fast-import and save state every N commits")
+  parser.add_option("--archive",dest="archivedir",
+      help="Also write the stream to the replayable archive ARCHIVEDIR, see gfiarchive.py")
+  parser.add_option("--bulk-read",action="store_true",dest="bulk_read",
+      default=False,help="Read file revisions from memory-mapped filelogs")
+  parser.add_option("--shards",type="int",dest="shards",
+      help="Write the blobs from N processes in parallel, then the commits")
+  parser.add_option("--stream-threshold",type="int",dest="stream_threshold",
+      help="Stream file revisions larger than this many bytes in chunks")
+  parser.add_option("--low-memory",action="store_true",dest="low_memory",
+      default=False,help="Keep memory flat however long the history (needs --store-dir)")
+  parser.add_option("--memory-limit",type="int",dest="memory_limit",
+      help="Limit the exporter's address space, memory-mapped files included, "
+      "to this many MB and abort beyond (git-fast-import is not limited)")
+  parser.add_option("--check-status",action="store_true",dest="check_status",
+      default=False,help="Verify changed files of non-merge revisions with hg status")
+
+  parser.add_option("--path-map",action="append",dest="path_map",
+      default=[],metavar="OLD=NEW",
+      help="Rewrite paths starting with OLD to start with NEW instead; "
+        "may be given more than once, the rewrites are applied in order")
+  parser.add_option("--include",action="append",dest="include",
+      default=[],metavar="PATTERN",
+      help="Only export paths matching the shell glob PATTERN (after --path-map)")
+  parser.add_option("--exclude",action="append",dest="exclude",
+      default=[],metavar="PATTERN",
+      help="Don't export paths matching the shell glob PATTERN (after --path-map)")
+  parser.add_option("--detracked",dest="detrackedfile",
+      help="Append the paths left out by --include and --exclude to DETRACKEDFILE")
+  parser.add_option("--transform",action="append",dest="transform",
+      default=[],metavar="NAME",
+      help="Pass the contents of text files through the built-in transform "
+        "NAME (strip-whitespace) or the function module:function; "
+        "may be given more than once")
 
   (options,args)=parser.parse_args()
 
   m=-1
   if options.max!=None: m=options.max
 
-  if options.marksfile==None: bail(parser,'--marks')
-  if options.mappingfile==None: bail(parser,'--mapping')
-  if options.headsfile==None: bail(parser,'--heads')
-  if options.statusfile==None: bail(parser,'--status')
+  if options.storedir==None:
+    if options.marksfile==None: bail(parser,'--marks')
+    if options.mappingfile==None: bail(parser,'--mapping')
+    if options.headsfile==None: bail(parser,'--heads')
+    if options.statusfile==None: bail(parser,'--status')
   if options.repourl==None: bail(parser,'--repo')
 
   a={}
@@ -397,5 +952,42 @@ if __name__=='__main__':
   if options.origin_name!=None:
     set_origin_name(options.origin_name)
 
+  detracked=None
+  if options.detrackedfile!=None:
+    detracked=open(options.detrackedfile,'a')
+  try:
+    paths=path_rules(parse_path_map(options.path_map),options.include,
+        options.exclude,detracked)
+    transforms=map(load_transform,options.transform)
+  except (ValueError,ImportError,AttributeError),e:
+    sys.stderr.write('Error: %s\n' % e)
+    sys.exit(2)
+
+  if options.store and options.storedir==None:
+    # not to be taken for an abbreviation of --store-dir
+    sys.stderr.write('Error: --store needs --store-dir\n')
+    sys.exit(2)
+  if options.low_memory and options.storedir==None:
+    # the text files are read into dicts as a whole
+    sys.stderr.write('Error: --low-memory needs --store-dir\n')
+    sys.exit(2)
+  cfg_low_memory=options.low_memory
+  cfg_check_status=options.check_status
+  if options.checkpoint!=None:
+    cfg_checkpoint_count=options.checkpoint
+  cfg_bulk_read=options.bulk_read
+  if options.shards!=None:
+    cfg_shards=options.shards
+    if cfg_shards>1 and options.archivedir!=None:
+      # the blobs would go to the workers' streams only
+      sys.stderr.write('Error: --archive can\'t be used with --shards\n')
+      sys.exit(2)
+  if options.stream_threshold!=None:
+    cfg_stream_threshold=options.stream_threshold
+  cfg_memory_limit=options.memory_limit
+
   sys.exit(hg2git(options.repourl,m,options.marksfile,options.mappingfile,options.headsfile,
-    options.statusfile,authors=a,sob=options.sob,force=options.force))
+    options.statusfile,authors=a,sob=options.sob,force=options.force,
+    blobsfile=options.blobsfile,verify_mapping=options.verify_mapping,
+    storedir=options.storedir,statsfile=options.statsfile,
+    fast_import=options.fast_import,archivedir=options.archivedir))
@@ -8,12 +8,15 @@ REPO=""
 PFX="hg2git"
 SFX_MAPPING="mapping"
 SFX_MARKS="marks"
+SFX_BLOBS="blobs"
 SFX_HEADS="heads"
 SFX_STATE="state"
+SFX_STORE="store"
+STORE=""
 GFI_OPTS=""
 PYTHON=${PYTHON:-python}
 
-USAGE="[--quiet] [-r <repo>] [--force] [-m <max>] [-s] [-A <file>] [-M <name>] [-o <name>]"
+USAGE="[--quiet] [-r <repo>] [--store] [--low-memory] [--force] [-m <max>] [-s] [-A <file>] [-M <name>] [-o <name>]"
 LONG_USAGE="Import hg repository <repo> up to either tip or <max>
 If <repo> is omitted, use last hg repository as obtained from state file,
 GIT_DIR/$PFX-$SFX_STATE by default.
@@ -27,10 +30,19 @@ Options:
 	-A	Read author map from file
 		(Same as in git-svnimport(1) and git-cvsimport(1))
 	-r	Mercurial repository to import
+	--store	Keep marks, mapping, heads and state in the binary store
+		GIT_DIR/$PFX-$SFX_STORE (used from then on; existing text
+		files are imported into it)
+	--low-memory
+		Keep the exporter's memory flat however long the history
+		(implies --store)
 	-M	Set the default branch name (default to 'master')
 	-o	Use <name> as branch namespace to track upstream (eg 'origin')
 	--force Ignore validation errors when converting, and pass --force
 		to git-fast-import(1)
+	--checkpoint <n>
+		Checkpoint git-fast-import(1) and save the state every <n>
+		commits; a failed import is resumed from the last checkpoint
 "
 
 . "$(git --exec-path)/git-sh-setup"
@@ -43,6 +55,14 @@ do
       shift
       REPO="$1"
       ;;
+    --store)
+      STORE=yes
+      ;;
+    --low-memory)
+      # needs the store, pass it on to hg-fast-export.py
+      STORE=yes
+      break
+      ;;
     --q|--qu|--qui|--quie|--quiet)
       GFI_OPTS="$GFI_OPTS --quiet"
       ;;
@@ -62,8 +82,71 @@ do
   shift
 done
 
+# --store and --low-memory also count after the options passed on
+for arg in "$@" ; do
+  case "$arg" in
+    --store|--low-memory)
+      STORE=yes
+      ;;
+  esac
+done
+
+STORE_DIR="$GIT_DIR/$PFX-$SFX_STORE"
+
+# add the marks git-fast-import exported to MARKS.tmp to the marks cache
+merge_marks () {
+  if [ -d "$STORE_DIR" ] ; then
+    # the store is updated in place with just the new marks
+    $PYTHON "$ROOT/hgstore.py" "$STORE_DIR" import-marks \
+      "$GIT_DIR/$PFX-$SFX_MARKS.tmp" || return 1
+  else
+    touch "$GIT_DIR/$PFX-$SFX_MARKS"
+    cat "$GIT_DIR/$PFX-$SFX_MARKS" "$GIT_DIR/$PFX-$SFX_MARKS.tmp" \
+    | uniq > "$GIT_DIR/$PFX-$SFX_MARKS.new" &&
+    mv "$GIT_DIR/$PFX-$SFX_MARKS.new" "$GIT_DIR/$PFX-$SFX_MARKS" || return 1
+  fi
+  rm -f "$GIT_DIR/$PFX-$SFX_MARKS.tmp"
+}
+
+# save SHA1s of current heads for incremental imports
+# and connectivity (plus sanity checking)
+save_heads () {
+  for head in `git branch | sed 's#^..##'` ; do
+    id="`git rev-parse $head`"
+    echo ":$head $id"
+  done > "$GIT_DIR/$PFX-$SFX_HEADS"
+  if [ -d "$STORE_DIR" ] ; then
+    $PYTHON "$ROOT/hgstore.py" "$STORE_DIR" import-heads \
+      "$GIT_DIR/$PFX-$SFX_HEADS" || return 1
+  fi
+}
+
+# a run killed as a whole leaves the marks of git-fast-import's last
+# checkpoint behind, and the branches it moved there: take them over so
+# that this run resumes after that checkpoint
+if [ -f "$GIT_DIR/$PFX-$SFX_MARKS.tmp" ] ; then
+  echo "Recovering the marks and heads of an interrupted run"
+  merge_marks || exit 1
+  save_heads || exit 1
+fi
+
+if [ -d "$STORE_DIR" ] ; then
+  STORE=yes
+elif [ x"$STORE" != x -a -f "$GIT_DIR/$PFX-$SFX_STATE" ] ; then
+  # carry on from a conversion done with the text files
+  $PYTHON "$ROOT/hgstore.py" \
+    --marks "$GIT_DIR/$PFX-$SFX_MARKS" \
+    --blobs "$GIT_DIR/$PFX-$SFX_BLOBS" \
+    --mapping "$GIT_DIR/$PFX-$SFX_MAPPING" \
+    --heads "$GIT_DIR/$PFX-$SFX_HEADS" \
+    --status "$GIT_DIR/$PFX-$SFX_STATE" \
+    "$STORE_DIR" import || exit 1
+fi
 # for convenience: get default repo from state file
-if [ x"$REPO" = x -a -f "$GIT_DIR/$PFX-$SFX_STATE" ] ; then
+if [ x"$REPO" = x -a x"$STORE" != x -a -d "$STORE_DIR" ] ; then
+  REPO="`$PYTHON "$ROOT/hgstore.py" "$STORE_DIR" get-state repo`"
+  echo "Using last hg repository \"$REPO\""
+elif [ x"$REPO" = x -a -f "$GIT_DIR/$PFX-$SFX_STATE" ] ; then
   REPO="`egrep '^:repo ' "$GIT_DIR/$PFX-$SFX_STATE" | cut -d ' ' -f 2`"
   echo "Using last hg repository \"$REPO\""
 fi
@@ -73,35 +156,35 @@ if [ ! -f "$GIT_DIR/$PFX-$SFX_MARKS" ] ; then
   touch "$GIT_DIR/$PFX-$SFX_MARKS"
 fi
 
-# cleanup on exit
-trap 'rm -f "$GIT_DIR/$PFX-$SFX_MARKS.old" "$GIT_DIR/$PFX-$SFX_MARKS.tmp"' 0
+# cleanup on exit; MARKS.tmp is left for the next run until merged
+trap 'rm -f "$GIT_DIR/$PFX-export-status.tmp"' 0
 
-GIT_DIR="$GIT_DIR" $PYTHON "$ROOT/hg-fast-export.py" \
+# the exit status of the exporter is lost in the pipe, so keep it aside
+echo 1 > "$GIT_DIR/$PFX-export-status.tmp"
+{ GIT_DIR="$GIT_DIR" $PYTHON "$ROOT/hg-fast-export.py" \
   --repo "$REPO" \
   --marks "$GIT_DIR/$PFX-$SFX_MARKS" \
+  --blobs "$GIT_DIR/$PFX-$SFX_BLOBS" \
   --mapping "$GIT_DIR/$PFX-$SFX_MAPPING" \
   --heads "$GIT_DIR/$PFX-$SFX_HEADS" \
   --status "$GIT_DIR/$PFX-$SFX_STATE" \
-  "$@" \
-| git fast-import $GFI_OPTS --export-marks="$GIT_DIR/$PFX-$SFX_MARKS.tmp" || exit 1
-
-# move recent marks cache out of the way...
-if [ -f "$GIT_DIR/$PFX-$SFX_MARKS" ] ; then
-  mv "$GIT_DIR/$PFX-$SFX_MARKS" "$GIT_DIR/$PFX-$SFX_MARKS.old"
-else
-  touch "$GIT_DIR/$PFX-$SFX_MARKS.old"
+  ${STORE:+--store-dir "$STORE_DIR"} \
+  "$@"
+  echo $? > "$GIT_DIR/$PFX-export-status.tmp"
+} | git fast-import $GFI_OPTS --export-marks="$GIT_DIR/$PFX-$SFX_MARKS.tmp"
+GFI_STATUS=$?
+EXPORT_STATUS=`cat "$GIT_DIR/$PFX-export-status.tmp"`
+
+# even if git-fast-import failed, keep the marks and heads of what it
+# made durable at its last checkpoint so that the next run resumes there
+if [ ! -f "$GIT_DIR/$PFX-$SFX_MARKS.tmp" ] ; then
+  touch "$GIT_DIR/$PFX-$SFX_MARKS.tmp"
 fi
 
-# ...to create a new merged one
-cat "$GIT_DIR/$PFX-$SFX_MARKS.old" "$GIT_DIR/$PFX-$SFX_MARKS.tmp" \
-| uniq > "$GIT_DIR/$PFX-$SFX_MARKS"
+merge_marks || exit 1
+save_heads || exit 1
 
-# save SHA1s of current heads for incremental imports
-# and connectivity (plus sanity checking)
-for head in `git branch | sed 's#^..##'` ; do
-  id="`git rev-parse $head`"
-  echo ":$head $id"
-done > "$GIT_DIR/$PFX-$SFX_HEADS"
+test $GFI_STATUS = 0 -a "$EXPORT_STATUS" = 0 || exit 1
 
 # check diff with color:
 # ( for i in `find . -type f | grep -v '\.git'` ; do diff -u $i $REPO/$i ; done | cdiff ) | less -r
@@ -10,6 +10,7 @@ SFX_MARKS="marks"
 SFX_MAPPING="mapping"
 SFX_HEADS="heads"
 SFX_STATE="state"
+SFX_STORE="store"
 QUIET=""
 PYTHON=${PYTHON:-python}
 
@@ -45,8 +46,18 @@ do
   shift
 done
 
+# a conversion done with --store keeps its state in the store
+STORE_DIR="$GIT_DIR/$PFX-$SFX_STORE"
+STORE=""
+if [ -d "$STORE_DIR" ] ; then
+  STORE=yes
+fi
+
 # for convenience: get default repo from state file
-if [ x"$REPO" = x -a -f "$GIT_DIR/$PFX-$SFX_STATE" ] ; then
+if [ x"$REPO" = x -a x"$STORE" != x ] ; then
+  REPO="`$PYTHON "$ROOT/hgstore.py" "$STORE_DIR" get-state repo`"
+  echo "Using last hg repository \"$REPO\""
+elif [ x"$REPO" = x -a -f "$GIT_DIR/$PFX-$SFX_STATE" ] ; then
   REPO="`egrep '^:repo ' "$GIT_DIR/$PFX-$SFX_STATE" | cut -d ' ' -f 2`"
   echo "Using last hg repository \"$REPO\""
 fi
@@ -62,6 +73,7 @@ GIT_DIR="$GIT_DIR" $PYTHON "$ROOT/hg-reset.py" \
   --mapping "$GIT_DIR/$PFX-$SFX_MAPPING" \
   --heads "$GIT_DIR/$PFX-$SFX_HEADS" \
   --status "$GIT_DIR/$PFX-$SFX_STATE" \
+  ${STORE:+--store-dir "$STORE_DIR"} \
   "$@"
 
 exit $?
@@ -4,6 +4,8 @@
 # License: MIT <http://www.opensource.org/licenses/mit-license.php>
 
 from mercurial import hg,util,ui,templatefilters
+from gfirewrite import cfg_blob_mark_base
+from gficache import load_cache,save_cache
 import re
 import os
 import sys
@@ -12,6 +14,16 @@ import sys
 cfg_master='master'
 # default origin name
 origin_name=''
+# snapshot of the git repository's refs, see get_git_sha1()
+git_refs=None
+# bound on the number of memoized fixup_user() results per authors map
+cfg_user_cache_size=10000
+# bound on the number of authors maps fixup_user() memoizes results for
+cfg_user_caches=8
+# memoized fixup_user() results: id(authors) -> (authors,{user: result})
+user_caches={}
+# how often fixup_user() could use a memoized result
+user_cache_stats={'hits':0,'misses':0}
 # silly regex to see if user field has email address
 user_re=re.compile('([^<]+) (<[^>]*>)$')
 # silly regex to clean out user names
@@ -34,6 +46,25 @@ def setup_repo(url):
   return myui,hg.repository(myui,url)
 
 def fixup_user(user,authors):
+  # most repositories only have a few dozen distinct committers, so
+  # remember the result for each user string and authors map
+  key=id(authors)
+  if key not in user_caches:
+    if len(user_caches)>=cfg_user_caches:
+      user_caches.clear()
+    user_caches[key]=(authors,{})
+  cache=user_caches[key][1]
+  r=cache.get(user)
+  if r!=None:
+    user_cache_stats['hits']+=1
+    return r
+  user_cache_stats['misses']+=1
+  if len(cache)>=cfg_user_cache_size:
+    cache.clear()
+  r=cache[user]=normalize_user(user,authors)
+  return r
+
+def normalize_user(user,authors):
   user=user.strip("\"")
   if authors!=None:
     # if we have an authors table, try to get mapping
@@ -75,40 +106,22 @@ def get_changeset(ui,repo,revision,authors={}):
   branch=get_branch(extra.get('branch','master'))
   return (node,manifest,fixup_user(user,authors),(time,tz),files,desc,branch,extra)
 
-def mangle_key(key):
-  return key
-
-def load_cache(filename,get_key=mangle_key):
-  cache={}
-  if not os.path.exists(filename):
-    return cache
-  f=open(filename,'r')
-  l=0
-  for line in f.readlines():
-    l+=1
-    fields=line.split(' ')
-    if fields==None or not len(fields)==2 or fields[0][0]!=':':
-      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l))
-      continue
-    # put key:value in cache, key without ^:
-    cache[get_key(fields[0][1:])]=fields[1].split('\n')[0]
-  f.close()
-  return cache
-
-def save_cache(filename,cache):
-  f=open(filename,'w+')
-  map(lambda x: f.write(':%s %s\n' % (str(x),str(cache.get(x)))),cache.keys())
-  f.close()
-
-def get_git_sha1(name,type='heads'):
+def load_git_refs():
+  """Read the sha1s of all refs with a single git-for-each-ref call."""
+  refs={}
   try:
-    # use git-rev-parse to support packed refs
-    cmd="git rev-parse --verify refs/%s/%s 2>%s" % (type,name,os.devnull)
-    p=os.popen(cmd)
-    l=p.readline()
+    p=os.popen("git for-each-ref --format='%%(objectname) %%(refname)' 2>%s" % os.devnull)
+    for l in p.readlines():
+      sha1,name=l.rstrip('\n').split(' ',1)
+      refs[name]=sha1
     p.close()
-    if l == None or len(l) == 0:
-      return None
-    return l[0:40]
   except IOError:
-    return None
+    pass
+  return refs
+
+def get_git_sha1(name,type='heads'):
+  # refs are read once and served from this snapshot for the whole run
+  global git_refs
+  if git_refs==None:
+    git_refs=load_git_refs()
+  return git_refs.get('refs/%s/%s' % (type,name))
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Binary store for hg-fast-export's marks, hg-to-git mapping, heads and
+state, as an alternative to the ':key value' text files.
+
+Commits and blobs each live in a table of fixed-width records: a 20 byte
+hg node (changeset node resp. blob key, the filenode unless transformed)
+followed by the 20 byte git sha1 fast-import assigned to it, all zeros
+while unknown. A changeset's record number is its hg revision, a blob's
+is its mark minus the blob mark base, so both are found in O(1) through
+a memory map of the table. Each table has a sorted index of (node,
+record number) pairs for O(log n) lookups by node; records appended
+since the index was last written are kept in a small in-memory dict
+until the index is rebuilt on close. In low-memory mode that dict is
+merged into the index whenever it reaches cfg_index_slack records, so
+memory stays flat however long the history.
+
+Heads and state are tiny and are kept as length-prefixed key/value pairs
+that are rewritten as a whole."""
+
+from mercurial import node
+from optparse import OptionParser
+from hg2git import load_cache,save_cache,cfg_blob_mark_base
+import mmap
+import os
+import struct
+import sys
+
+# rebuild a table's sorted index once this many records are not in it
+cfg_index_slack=4096
+
+nullsha=node.nullid
+
+class table(object):
+  """Fixed-width (hg node, git sha1) records indexed by number and node."""
+
+  recsize=40
+  idxsize=24
+
+  def __init__(self,path,slack=None):
+    """Open the table in path. If slack is given, merge the records not
+    in the index into it as soon as there are that many."""
+    self.path=path
+    self.idxpath=path+'.idx'
+    self.slack=slack
+    for p in (self.path,self.idxpath):
+      if not os.path.exists(p):
+        open(p,'wb').close()
+    self._fp=open(self.path,'r+b')
+    self._map=None
+    self._idxmap=None
+    self._len=os.path.getsize(self.path)/self.recsize
+    self._indexed=os.path.getsize(self.idxpath)/self.idxsize
+    if self._indexed>self._len:
+      # stale index of a table that was truncated, start over
+      self._drop_index()
+    self._tail={}
+    for i in xrange(self._indexed,self._len):
+      self._tail[self.key(i)]=i
+
+  def _mapped(self):
+    if self._map==None and self._len>0:
+      self._fp.flush()
+      self._map=mmap.mmap(self._fp.fileno(),self._len*self.recsize,access=mmap.ACCESS_READ)
+    return self._map
+
+  def _idxmapped(self):
+    if self._idxmap==None and self._indexed>0:
+      f=open(self.idxpath,'rb')
+      self._idxmap=mmap.mmap(f.fileno(),self._indexed*self.idxsize,access=mmap.ACCESS_READ)
+      f.close()
+    return self._idxmap
+
+  def _remap(self):
+    if self._map!=None:
+      self._map.close()
+      self._map=None
+
+  def _drop_index(self):
+    if self._idxmap!=None:
+      self._idxmap.close()
+      self._idxmap=None
+    open(self.idxpath,'wb').close()
+    self._indexed=0
+
+  def __len__(self):
+    return self._len
+
+  def key(self,i):
+    off=i*self.recsize
+    return self._mapped()[off:off+20]
+
+  def sha1(self,i):
+    """Return the hex git sha1 of record i or None if still unknown."""
+    if i<0 or i>=self._len:
+      return None
+    off=i*self.recsize+20
+    s=self._mapped()[off:off+20]
+    if s==nullsha:
+      return None
+    return node.hex(s)
+
+  def find(self,key):
+    """Return the number of the record for binary node key or None."""
+    i=self._tail.get(key)
+    if i!=None:
+      return i
+    m=self._idxmapped()
+    lo,hi=0,self._indexed
+    while lo<hi:
+      mid=(lo+hi)/2
+      off=mid*self.idxsize
+      k=m[off:off+20]
+      if k<key:
+        lo=mid+1
+      elif k>key:
+        hi=mid
+      else:
+        return struct.unpack('>L',m[off+20:off+24])[0]
+    return None
+
+  def append(self,key,sha1=None):
+    self._fp.seek(0,2)
+    self._fp.write(key+(sha1 and node.bin(sha1) or nullsha))
+    self._tail[key]=self._len
+    self._len+=1
+    self._remap()
+    if self.slack!=None and len(self._tail)>=self.slack:
+      self._merge_index()
+    return self._len-1
+
+  def set_key(self,i,key):
+    """Replace the node of record i, keeping its sha1."""
+    if i==self._len:
+      return self.append(key)
+    old=self.key(i)
+    if old==key:
+      return i
+    self._fp.seek(i*self.recsize)
+    self._fp.write(key)
+    self._remap()
+    # the index may now point elsewhere, so rebuild it on close
+    if i<self._indexed:
+      self._drop_index()
+      self._tail=dict((self.key(j),j) for j in xrange(self._len))
+    else:
+      if self._tail.get(old)==i: del self._tail[old]
+      self._tail[key]=i
+    return i
+
+  def flush(self):
+    self._fp.flush()
+    os.fsync(self._fp.fileno())
+
+  def set_sha1(self,i,sha1):
+    self._fp.seek(i*self.recsize+20)
+    self._fp.write(node.bin(sha1))
+    self._remap()
+
+  def close(self):
+    if len(self._tail)>cfg_index_slack or (self._indexed==0 and self._len>0):
+      self._merge_index()
+    self.unmap()
+    self._fp.close()
+
+  def unmap(self):
+    """Drop the memory maps; the pages read through them count as the
+    process' memory until then."""
+    self._remap()
+    if self._idxmap!=None:
+      self._idxmap.close()
+      self._idxmap=None
+
+  def _merge_index(self):
+    """Merge the records of the in-memory dict into the sorted index,
+    reading the old index sequentially."""
+    tail=sorted(self._tail.iteritems())
+    self.unmap()
+    tmp=self.idxpath+'.tmp'
+    f=open(tmp,'wb')
+    old=open(self.idxpath,'rb')
+    t=0
+    for n in xrange(self._indexed):
+      e=old.read(self.idxsize)
+      while t<len(tail) and tail[t][0]<e[:20]:
+        f.write(tail[t][0]+struct.pack('>L',tail[t][1]))
+        t+=1
+      f.write(e)
+    old.close()
+    for k,i in tail[t:]:
+      f.write(k+struct.pack('>L',i))
+    f.close()
+    os.rename(tmp,self.idxpath)
+    self._indexed+=len(tail)
+    self._tail={}
+
+def read_dict(path):
+  d={}
+  if not os.path.exists(path):
+    return d
+  f=open(path,'rb')
+  data=f.read()
+  f.close()
+  pos=0
+  while pos<len(data):
+    l=struct.unpack('>H',data[pos:pos+2])[0]
+    k=data[pos+2:pos+2+l]
+    pos+=2+l
+    l=struct.unpack('>H',data[pos:pos+2])[0]
+    d[k]=data[pos+2:pos+2+l]
+    pos+=2+l
+  return d
+
+def write_dict(path,d):
+  tmp=path+'.tmp'
+  f=open(tmp,'wb')
+  for k,v in sorted(d.items()):
+    k,v=str(k),str(v)
+    f.write(struct.pack('>H',len(k))+k+struct.pack('>H',len(v))+v)
+  f.flush()
+  os.fsync(f.fileno())
+  f.close()
+  os.rename(tmp,path)
+
+class marks_view(object):
+  """old_marks as hg-fast-export uses it: mark-1 -> git sha1."""
+  def __init__(self,store):
+    self.store=store
+  def get(self,k,default=None):
+    if k>=cfg_blob_mark_base:
+      return self.store.blobs.sha1(k-cfg_blob_mark_base) or default
+    return self.store.revs.sha1(k) or default
+
+class mapping_view(object):
+  """mapping_cache as hg-fast-export uses it: hex node -> str(rev)."""
+  def __init__(self,store):
+    self.revs=store.revs
+  def __len__(self):
+    return len(self.revs)
+  def get(self,k,default=None):
+    i=self.revs.find(node.bin(k))
+    if i==None:
+      return default
+    return str(i)
+  def __contains__(self,k):
+    return self.revs.find(node.bin(k))!=None
+  def __getitem__(self,k):
+    v=self.get(k)
+    if v==None:
+      raise KeyError(k)
+    return v
+  def __setitem__(self,k,v):
+    self.revs.set_key(int(v),node.bin(k))
+  def clear(self):
+    # keys are overwritten in place from revision 0 on, keeping the sha1s
+    pass
+
+class blob_marks_view(object):
+  """blob_marks as hg-fast-export uses it: hex blob key -> mark."""
+  def __init__(self,store):
+    self.blobs=store.blobs
+  def __len__(self):
+    return len(self.blobs)
+  def get(self,k,default=None):
+    i=self.blobs.find(node.bin(k))
+    if i==None:
+      return default
+    return cfg_blob_mark_base+i+1
+  def __setitem__(self,k,v):
+    self.blobs.set_key(v-cfg_blob_mark_base-1,node.bin(k))
+
+class blob_refs_view(object):
+  """blob_refs as hg-fast-export uses it: hex blob key -> sha1 or mark.
+
+  Blobs of earlier runs are looked up in the store, blobs written in
+  this run under their own record are flagged by record number in a
+  bytearray and referenced by mark. Other references, like the sha1s of
+  blobs written by --shards workers, are remembered as they are."""
+  def __init__(self,store):
+    self.blobs=store.blobs
+    self.marked=bytearray()
+    self.written={}
+  def get(self,k,default=None):
+    v=self.written.get(k)
+    if v!=None:
+      return v
+    i=self.blobs.find(node.bin(k))
+    if i==None:
+      return default
+    if i<len(self.marked) and self.marked[i]:
+      return ':%d' % (cfg_blob_mark_base+i+1)
+    return self.blobs.sha1(i) or default
+  def __setitem__(self,k,v):
+    i=self.blobs.find(node.bin(k))
+    if i!=None and v==':%d' % (cfg_blob_mark_base+i+1):
+      if i>=len(self.marked):
+        self.marked.extend(bytearray(i+1-len(self.marked)))
+      self.marked[i]=1
+    else:
+      self.written[k]=v
+
+class store(object):
+  def __init__(self,path,low_memory=False):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path=path
+    slack=low_memory and cfg_index_slack or None
+    self.revs=table(os.path.join(path,'revs'),slack)
+    self.blobs=table(os.path.join(path,'blobs'),slack)
+    self.heads=read_dict(os.path.join(path,'heads'))
+    self.state=read_dict(os.path.join(path,'state'))
+
+  def marks(self):
+    return marks_view(self)
+
+  def mapping(self):
+    return mapping_view(self)
+
+  def blob_marks(self):
+    return blob_marks_view(self)
+
+  def blob_refs(self):
+    return blob_refs_view(self)
+
+  def unmap(self):
+    self.revs.unmap()
+    self.blobs.unmap()
+
+  def save(self):
+    self.revs.flush()
+    self.blobs.flush()
+    write_dict(os.path.join(self.path,'heads'),self.heads)
+    write_dict(os.path.join(self.path,'state'),self.state)
+
+  def close(self):
+    self.save()
+    self.revs.close()
+    self.blobs.close()
+
+  def set_mark(self,mark,sha1):
+    """Record the sha1 git-fast-import gave mark."""
+    if mark>cfg_blob_mark_base:
+      t,i=self.blobs,mark-cfg_blob_mark_base-1
+    else:
+      t,i=self.revs,mark-1
+    if i>=len(t):
+      sys.stderr.write('Mark :%d unknown to store, skipping\n' % mark)
+      return
+    t.set_sha1(i,sha1)
+
+  def set_marks(self,marks):
+    for mark,sha1 in sorted(marks.iteritems()):
+      self.set_mark(mark,sha1)
+
+  def import_marks(self,filename):
+    """Record the sha1s of a git-fast-import --export-marks file, read
+    line by line."""
+    for l,line in enumerate(open(filename)):
+      fields=line.split()
+      if len(fields)!=2 or fields[0][:1]!=':':
+        sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l+1))
+        continue
+      self.set_mark(int(fields[0][1:]),fields[1])
+
+  def import_text(self,marksfile,mappingfile,headsfile,statefile,blobsfile=None):
+    mapping=load_cache(mappingfile,get_value=int)
+    revs=sorted((rev,n) for n,rev in mapping.iteritems())
+    for rev,n in revs:
+      if rev!=len(self.revs):
+        sys.stderr.write('Mapping has no entry for r%d, stopping there\n' % len(self.revs))
+        break
+      self.revs.append(node.bin(n))
+    if blobsfile!=None:
+      blobs=load_cache(blobsfile,get_value=int)
+      for mark,n in sorted((mark,n) for n,mark in blobs.iteritems()):
+        self.blobs.set_key(mark-cfg_blob_mark_base-1,node.bin(n))
+    self.import_marks(marksfile)
+    self.heads.update(load_cache(headsfile))
+    self.state.update(load_cache(statefile))
+
+  def export_text(self,marksfile,mappingfile,headsfile,statefile,blobsfile=None):
+    marks,mapping,blobs={},{},{}
+    for i in xrange(len(self.revs)):
+      mapping[node.hex(self.revs.key(i))]=i
+      sha1=self.revs.sha1(i)
+      if sha1!=None: marks[i+1]=sha1
+    for i in xrange(len(self.blobs)):
+      mark=cfg_blob_mark_base+i+1
+      blobs[node.hex(self.blobs.key(i))]=mark
+      sha1=self.blobs.sha1(i)
+      if sha1!=None: marks[mark]=sha1
+    save_cache(marksfile,marks)
+    save_cache(mappingfile,mapping)
+    save_cache(headsfile,self.heads)
+    save_cache(statefile,self.state)
+    if blobsfile!=None:
+      save_cache(blobsfile,blobs)
+
+if __name__=='__main__':
+  usage='''%prog [options] STORE COMMAND [ARGS]
+
+Commands:
+  import        Create or update STORE from the text files given as options
+  export        Write the text files given as options from STORE
+  import-marks  Record sha1s from the git-fast-import marks file ARGS
+  import-heads  Replace the heads in STORE by those of the text file ARGS
+  get-state     Print the state entry named ARGS
+  set-state     Set the state entry named by the first of ARGS to the second'''
+  parser=OptionParser(usage=usage)
+  parser.add_option("--marks",dest="marksfile",
+      help="git-fast-import marks file")
+  parser.add_option("--mapping",dest="mappingfile",
+      help="hg-to-git SHA1 mapping file")
+  parser.add_option("--heads",dest="headsfile",
+      help="git heads file")
+  parser.add_option("--status",dest="statusfile",
+      help="status file")
+  parser.add_option("--blobs",dest="blobsfile",
+      help="hg filenode to blob mark mapping file")
+
+  (options,args)=parser.parse_args()
+
+  if len(args)<2:
+    parser.print_help()
+    sys.exit(2)
+
+  s=store(args[0])
+  cmd=args[1]
+  if cmd in ('import','export'):
+    for opt in ('marksfile','mappingfile','headsfile','statusfile'):
+      if getattr(options,opt)==None:
+        sys.stderr.write('Error: No --%s option given\n' % opt[:-4])
+        sys.exit(2)
+    f=cmd=='import' and s.import_text or s.export_text
+    f(options.marksfile,options.mappingfile,options.headsfile,
+        options.statusfile,options.blobsfile)
+  elif cmd=='import-marks' and len(args)==3:
+    s.import_marks(args[2])
+  elif cmd=='import-heads' and len(args)==3:
+    s.heads=load_cache(args[2])
+  elif cmd=='get-state' and len(args)==3:
+    v=s.state.get(args[2])
+    if v!=None: print v
+  elif cmd=='set-state' and len(args)==4:
+    s.state[args[2]]=args[3]
+  else:
+    parser.print_help()
+    sys.exit(2)
+  s.close()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Compact revision graph of a changelog for hg-reset, which asks for the
+heads below a revision: Mercurial's own headrevs() only knows those of
+the whole changelog."""
+
+from array import array
+
+class revgraph(object):
+  """The parents of every revision of a changelog in two arrays, built
+  once from its index.
+
+  Parents are stored shifted by one so that the null revision is 0 and
+  masks over the graph can use slot 0 for it."""
+
+  def __init__(self,changelog):
+    index=changelog.index
+    self.size=n=len(changelog)
+    self.p1=p1=array('i',[0])*n
+    self.p2=p2=array('i',[0])*n
+    for r in xrange(n):
+      e=index[r]
+      p1[r]=e[5]+1
+      p2[r]=e[6]+1
+
+  def heads(self,max=None):
+    """Revisions below max that have no children below max, ascending.
+
+    Without revisions, this is the null revision."""
+    if max==None or max>self.size:
+      max=self.size
+    # slot p is set if revision p-1 has a child
+    haschild=bytearray(max+1)
+    p1,p2=self.p1,self.p2
+    for r in xrange(max):
+      haschild[p1[r]]=1
+      haschild[p2[r]]=1
+    if max==0:
+      return [-1]
+    return [r for r in xrange(max) if not haschild[r+1]]
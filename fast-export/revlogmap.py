@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Read-only bulk access to the filelogs of a Mercurial repository.
+
+Going through filectx().data() builds a new filelog for every file
+revision read, parsing its whole index again and rebuilding the delta
+chain from its base, as the fulltext cache of the old filelog object
+is lost. Here the .i and .d files of a filelog are memory-mapped once,
+its index is parsed once and the fulltext last read is kept, so that
+reading revisions in order only applies the deltas in between."""
+
+from mercurial import mdiff,node,revlog
+from collections import OrderedDict
+import mmap
+import os
+import struct
+
+# number of filelogs kept open, each one holding its last fulltext and
+# up to two file descriptors
+cfg_open_revlogs=256
+
+indexformat='>Qiiiiii20s12x'
+entrysize=struct.calcsize(indexformat)
+
+def map_file(path):
+  """Memory-map file path or return '' if it is empty."""
+  f=open(path,'rb')
+  try:
+    size=os.fstat(f.fileno()).st_size
+    if size==0:
+      return ''
+    return mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+
+class revlogmap(object):
+  def __init__(self,indexfile,datafile):
+    """Map the revlog stored in indexfile and datafile. Raise ValueError
+    for revlogs this reader doesn't understand."""
+    self.index=map_file(indexfile)
+    version=0
+    if len(self.index)>=4:
+      version=struct.unpack('>I',self.index[:4])[0]
+    if version&0xFFFF!=revlog.REVLOGNG or version&revlog.REVLOGGENERALDELTA:
+      raise ValueError('unsupported revlog version %x in %s' % (version,indexfile))
+    self.inline=version&revlog.REVLOGNGINLINEDATA
+    self.data=self.inline and self.index or map_file(datafile)
+    # (data offset,compressed length,raw length,base,p1,p2,node) per rev
+    self.entries=entries=[]
+    self.nodemap={node.nullid:-1}
+    pos=0
+    while pos+entrysize<=len(self.index):
+      e=struct.unpack(indexformat,self.index[pos:pos+entrysize])
+      rev=len(entries)
+      start=rev>0 and e[0]>>16 or 0
+      if self.inline:
+        start+=(rev+1)*entrysize
+        pos+=e[1]
+      pos+=entrysize
+      entries.append((start,e[1],e[2],e[3],e[5],e[6],e[7]))
+      self.nodemap[e[7]]=rev
+    # (rev,text) of the fulltext read last
+    self.cache=None
+
+  def rev(self,n):
+    return self.nodemap[n]
+
+  def rawsize(self,rev):
+    """Size of revision rev including copy metadata or -1 if unknown."""
+    return self.entries[rev][2]
+
+  def chunk(self,rev):
+    start,length=self.entries[rev][:2]
+    return revlog.decompress(self.data[start:start+length])
+
+  def revision(self,rev):
+    """Fulltext of revision rev, checked against its node."""
+    if self.cache!=None and self.cache[0]==rev:
+      return self.cache[1]
+    e=self.entries
+    base=e[rev][3]
+    if self.cache!=None and base<=self.cache[0]<rev:
+      # only apply the deltas after the revision read last
+      first,text=self.cache[0]+1,self.cache[1]
+    else:
+      first,text=base+1,str(self.chunk(base))
+    text=mdiff.patches(text,[self.chunk(r) for r in xrange(first,rev+1)])
+    p1,p2=e[rev][4:6]
+    p1=p1>=0 and e[p1][6] or node.nullid
+    p2=p2>=0 and e[p2][6] or node.nullid
+    if revlog.hash(text,p1,p2)!=e[rev][6]:
+      raise revlog.RevlogError('integrity check failed on rev %d' % rev)
+    self.cache=(rev,text)
+    return text
+
+  def close(self):
+    # the data of inline revlogs is in the index
+    if not self.inline and self.data!='':
+      self.data.close()
+    if self.index!='':
+      self.index.close()
+
+class bulkreader(object):
+  """File data of a repository by path and filenode, read through
+  revlogmap. Filelogs it can't read are left to the caller."""
+
+  def __init__(self,repo,size=cfg_open_revlogs):
+    self.repo=repo
+    self.size=size
+    self.revlogs=OrderedDict()
+
+  def revlog(self,path):
+    """The revlogmap of the filelog of path or None."""
+    rl=self.revlogs.pop(path,False)
+    if rl==False:
+      join=self.repo.store.join
+      try:
+        rl=revlogmap(join('data/%s.i' % path),join('data/%s.d' % path))
+      except ValueError:
+        rl=None
+      if len(self.revlogs)>=self.size:
+        _,old=self.revlogs.popitem(last=False)
+        if old!=None:
+          old.close()
+    # most recently used last
+    self.revlogs[path]=rl
+    return rl
+
+  def rawsize(self,path,filenode):
+    """Size of a file revision including copy metadata, or -1 if it is
+    unknown or the filelog can't be read here."""
+    rl=self.revlog(path)
+    if rl==None:
+      return -1
+    return rl.rawsize(rl.rev(filenode))
+
+  def read(self,path,filenode):
+    """Data of a file revision without copy metadata, like
+    filelog.read(), or None if the filelog can't be read here."""
+    rl=self.revlog(path)
+    if rl==None:
+      return None
+    t=rl.revision(rl.rev(filenode))
+    if not t.startswith('\1\n'):
+      return t
+    return t[t.index('\1\n',2)+2:]
+
+  def close(self):
+    for rl in self.revlogs.itervalues():
+      if rl!=None:
+        rl.close()
+    self.revlogs.clear()
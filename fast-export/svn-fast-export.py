@@ -12,101 +12,301 @@ trunk_path = '/trunk/'
 branches_path = '/branches/'
 tags_path = '/tags/'
 
-first_rev = 1
 final_rev = 0
 
+# file contents are read from the repository in chunks of this size
+read_chunk = 1 << 20
+# progress is reported every this many revisions
+progress_every = 1000
+
+# with --readers, file contents are read by that many worker processes
+# up to prefetch_revisions revisions ahead, holding no more than
+# prefetch_bytes of contents at a time
+readers = 0
+prefetch_revisions = 100
+prefetch_bytes = 256 << 20
+
+# marks of the blobs written so far by the MD5 of their contents, kept
+# across runs in the --blobs file
+blob_marks = {}
+# git sha1s of the marks git-fast-import exported in earlier runs
+old_marks = {}
+# marks of the blobs written in this run
+written = set()
+# the next blob mark to hand out; a commit's mark is its svn revision,
+# blob marks start above cfg_blob_mark_base
+next_mark = 0
+# last exported revision and the head revision of every branch, kept
+# across runs in the --state file
+state = {}
+# the commit every branch continues from, a mark or a sha1
+heads = {}
+
 import sys, os.path
+import multiprocessing
+import pipes
+from collections import deque
 from optparse import OptionParser
 from time import mktime, strptime
-from svn.fs import svn_fs_file_length, svn_fs_file_contents, svn_fs_is_dir, svn_fs_revision_root, svn_fs_youngest_rev, svn_fs_revision_proplist, svn_fs_paths_changed
-from svn.core import svn_pool_create, svn_pool_clear, svn_pool_destroy, svn_stream_for_stdout, svn_stream_copy, svn_stream_close, run_app
+from svn.fs import svn_fs_file_length, svn_fs_file_contents, svn_fs_file_md5_checksum, svn_fs_check_path, svn_fs_revision_root, svn_fs_youngest_rev, svn_fs_revision_proplist, svn_fs_paths_changed2
+from svn.core import svn_pool_create, svn_pool_clear, svn_pool_destroy, svn_stream_read, svn_stream_close, run_app, svn_node_dir, svn_node_unknown
 from svn.repos import svn_repos_open, svn_repos_fs
+from gfiwriter import writer
+from gficache import load_cache, save_cache
+from gfirewrite import cfg_blob_mark_base
+
+# the git-fast-import stream
+out = None
+# the repository and the revision pool of a reader process
+reader_fs = None
+reader_pool = None
 
 ct_short = ['M', 'A', 'D', 'R', 'X']
 
+def new_mark():
+    global next_mark
+    mark = next_mark
+    next_mark += 1
+    return mark
+
+def blob_key(root, path, pool):
+    """Return the MD5 of the contents of path in hex, or None if the
+    repository doesn't know it."""
+    checksum = svn_fs_file_md5_checksum(root, path, pool)
+    if checksum and checksum != '\0' * 16:
+        return checksum.encode('hex_codec')
+    return None
+
+def known_blob(key):
+    """Return a reference to a blob with the contents of MD5 key written
+    before, or None if it has to be written."""
+    mark = blob_marks.get(key)
+    if mark == None:
+        return None
+    if mark in written:
+        return ":%d" % mark
+    # blobs of earlier runs can only be referenced by their sha1
+    return old_marks.get(mark)
+
+def new_blob(key):
+    """Start a blob with the contents of MD5 key, to be followed by its
+    data, and return a reference to it."""
+    # a blob of an earlier run that git-fast-import didn't make durable
+    # is written again under its old mark
+    mark = blob_marks.get(key)
+    if mark == None:
+        mark = new_mark()
+    out.line("blob")
+    out.line("mark :%d" % mark)
+    written.add(mark)
+    if key != None:
+        blob_marks[key] = mark
+    return ":%d" % mark
+
+def blob_ref(root, path, pool):
+    """Return a reference to a blob with the contents of path, writing
+    the blob only if the same contents weren't written before."""
+    key = blob_key(root, path, pool)
+    ref = known_blob(key)
+    if ref == None:
+        ref = new_blob(key)
+        dump_file_blob(root, path, pool)
+    return ref
+
 def dump_file_blob(root, full_path, pool):
     stream_length = svn_fs_file_length(root, full_path, pool)
     stream = svn_fs_file_contents(root, full_path, pool)
-    sys.stdout.write("data %s\n" % stream_length)
-    sys.stdout.flush()
-    ostream = svn_stream_for_stdout(pool)
-    svn_stream_copy(stream, ostream, pool)
-    svn_stream_close(ostream)
-    sys.stdout.write("\n")
-
-
-def export_revision(rev, repo, fs, pool):
-    sys.stderr.write("Exporting revision %s... " % rev)
-
-    revpool = svn_pool_create(pool)
-    svn_pool_clear(revpool)
-
-    # Open a root object representing the youngest (HEAD) revision.
-    root = svn_fs_revision_root(fs, rev, revpool)
-
-    # And the list of what changed in this revision.
-    changes = svn_fs_paths_changed(root, revpool)
-
-    i = 1
-    marks = {}
-    file_changes = []
-
-    for path, change_type in changes.iteritems():
-        c_t = ct_short[change_type.change_kind]
-        if svn_fs_is_dir(root, path, revpool):
-            continue
-
+    out.write("data %s\n" % stream_length)
+    while True:
+        data = svn_stream_read(stream, read_chunk)
+        if not data:
+            break
+        out.write(data)
+    svn_stream_close(stream)
+    out.write("\n")
+
+def read_file(root, path, pool):
+    stream = svn_fs_file_contents(root, path, pool)
+    chunks = []
+    while True:
+        data = svn_stream_read(stream, read_chunk)
+        if not data:
+            break
+        chunks.append(data)
+    svn_stream_close(stream)
+    return ''.join(chunks)
+
+
+def changed_files(root, pool):
+    """Return (change, path, name) of the files changed in trunk in the
+    revision of root, name being the path relative to trunk."""
+    # The changed paths come with the kind of their node, so the tree
+    # of the revision is only looked at for repositories that don't
+    # record it.
+    changes = svn_fs_paths_changed2(root, pool)
+
+    files = []
+    prefix = len(trunk_path)
+
+    for path, change in changes.iteritems():
         if not path.startswith(trunk_path):
             # We don't handle branches. Or tags. Yet.
-            pass
-        else:
-            if c_t == 'D':
-                file_changes.append("D %s" % path.replace(trunk_path, ''))
-            else:
-                marks[i] = path.replace(trunk_path, '')
-                file_changes.append("M 644 :%s %s" % (i, marks[i]))
-                sys.stdout.write("blob\nmark :%s\n" % i)
-                dump_file_blob(root, path, revpool)
-                i += 1
+            continue
+        c_t = ct_short[change.change_kind]
+        if c_t != 'D':
+            # deleting a directory deletes everything below it in git
+            # too, other changes to directories don't matter
+            kind = change.node_kind
+            if kind == svn_node_unknown:
+                kind = svn_fs_check_path(root, path, pool)
+            if kind == svn_node_dir:
+                continue
+        files.append((c_t, path, path[prefix:]))
+    return files
+
+def write_commit(rev, fs, pool, file_changes):
+    """Write the commit of revision rev with the file_changes lines,
+    unless there are none. Return whether it was written."""
+    if len(file_changes) == 0:
+        return False
 
     # Get the commit author and message
-    props = svn_fs_revision_proplist(fs, rev, revpool)
+    props = svn_fs_revision_proplist(fs, rev, pool)
 
-    # Do the recursive crawl.
     if props.has_key('svn:author'):
         author = "%s <%s@localhost>" % (props['svn:author'], props['svn:author'])
     else:
         author = 'nobody <nobody@localhost>'
 
-    if len(file_changes) == 0:
-        svn_pool_destroy(revpool)
-        sys.stderr.write("skipping.\n")
-        return
-
     svndate = props['svn:date'][0:-8]
     commit_time = mktime(strptime(svndate, '%Y-%m-%dT%H:%M:%S'))
-    sys.stdout.write("commit refs/heads/master\n")
-    sys.stdout.write("committer %s %s -0000\n" % (author, int(commit_time)))
-    sys.stdout.write("data %s\n" % len(props['svn:log']))
-    sys.stdout.write(props['svn:log'])
-    sys.stdout.write("\n")
-    sys.stdout.write('\n'.join(file_changes))
-    sys.stdout.write("\n\n")
+    branch = 'refs/heads/master'
+    log = props['svn:log']
+    # the whole commit in one write
+    pieces = ["commit %s\nmark :%d\ncommitter %s %s -0000\ndata %d\n" %
+              (branch, rev, author, int(commit_time), len(log)), log, "\n"]
+    if branch in heads:
+        pieces.append("from %s\n" % heads[branch])
+    pieces.append('\n'.join(file_changes))
+    pieces.append("\n\n")
+    out.write(*pieces)
+    heads[branch] = ":%d" % rev
+    state[branch] = rev
+    return True
 
-    svn_pool_destroy(revpool)
-
-    sys.stderr.write("done!\n")
-
-    #if rev % 1000 == 0:
-    #    sys.stderr.write("gc: %s objects\n" % len(gc.get_objects()))
-    #    sleep(5)
+def export_revision(rev, repo, fs, pool):
+    """Export revision rev, allocating from pool which the caller clears
+    before every revision."""
+    # Open a root object representing the revision.
+    root = svn_fs_revision_root(fs, rev, pool)
 
+    file_changes = []
+    for c_t, path, name in changed_files(root, pool):
+        if c_t == 'D':
+            file_changes.append("D %s" % name)
+        else:
+            ref = blob_ref(root, path, pool)
+            file_changes.append("M 644 %s %s" % (ref, name))
+    return write_commit(rev, fs, pool, file_changes)
+
+
+def open_reader(repos_path):
+    """Open the repository in a reader process."""
+    global reader_fs, reader_pool
+    pool = svn_pool_create()
+    reader_fs = svn_repos_fs(svn_repos_open(repos_path, pool))
+    reader_pool = svn_pool_create(pool)
+
+def prefetch_revision(rev):
+    """Read the changed files of revision rev in a reader process and
+    return (change, path, name, key, data) for each. The data of files
+    beyond the revision's share of prefetch_bytes is left out, None."""
+    svn_pool_clear(reader_pool)
+    root = svn_fs_revision_root(reader_fs, rev, reader_pool)
+    budget = prefetch_bytes / prefetch_revisions
+    files = []
+    for c_t, path, name in changed_files(root, reader_pool):
+        key, data = None, None
+        if c_t != 'D':
+            key = blob_key(root, path, reader_pool)
+            length = svn_fs_file_length(root, path, reader_pool)
+            if length <= budget:
+                budget -= length
+                data = read_file(root, path, reader_pool)
+        files.append((c_t, path, name, key, data))
+    return files
+
+def export_prefetched(rev, files, fs, pool):
+    """Export revision rev from the files read by prefetch_revision,
+    reading those it left out here."""
+    root = None
+    file_changes = []
+    for c_t, path, name, key, data in files:
+        if c_t == 'D':
+            file_changes.append("D %s" % name)
+            continue
+        ref = known_blob(key)
+        if ref == None:
+            ref = new_blob(key)
+            if data != None:
+                out.data(data)
+            else:
+                if root == None:
+                    root = svn_fs_revision_root(fs, rev, pool)
+                dump_file_blob(root, path, pool)
+        file_changes.append("M 644 %s %s" % (ref, name))
+    return write_commit(rev, fs, pool, file_changes)
+
+def prefetched_revisions(workers, first, last):
+    """Yield (rev, files) of revisions first..last in order, read ahead
+    by the pool of reader processes workers."""
+    window = deque()
+    next_rev = first
+    while next_rev <= last or window:
+        while next_rev <= last and len(window) < prefetch_revisions:
+            window.append((next_rev, workers.apply_async(prefetch_revision, (next_rev,))))
+            next_rev += 1
+        rev, result = window.popleft()
+        yield rev, result.get()
+
+
+def resume_revision():
+    """Return the revision to continue after, the last one of the last
+    run unless git-fast-import didn't make its commits durable. Set up
+    the heads of the branches to continue from."""
+    last = int(state.get('rev', 0))
+    for branch, rev in state.items():
+        if not branch.startswith('refs/'):
+            continue
+        rev = int(rev)
+        # step back to the last commit git-fast-import has a mark for
+        while rev > 0 and old_marks.get(rev) == None:
+            rev -= 1
+        if rev < int(state[branch]):
+            sys.stderr.write("%s: resuming after revision %d\n" % (branch, rev))
+            last = min(last, rev)
+        if rev > 0:
+            heads[branch] = old_marks[rev]
+            state[branch] = rev
+        else:
+            # none of its commits are known, start the branch over
+            # rather than stack them on it again
+            out.write("reset %s\n\n" % branch)
+            del state[branch]
+    return last
 
 def crawl_revisions(pool, repos_path):
     """Open the repository at REPOS_PATH, and recursively crawl all its
     revisions."""
     global final_rev
 
+    # the readers are forked before the repository is opened here, and
+    # must not inherit anything still to be written
+    workers = None
+    if readers > 0:
+        out.flush()
+        workers = multiprocessing.Pool(readers, open_reader, (repos_path,))
+
     # Open the repository at REPOS_PATH, and get a reference to its
     # versioning filesystem.
     repos_obj = svn_repos_open(repos_path, pool)
@@ -116,11 +316,33 @@ def crawl_revisions(pool, repos_path):
     youngest_rev = svn_fs_youngest_rev(fs_obj, pool)
 
 
-    first_rev = 1
+    first_rev = resume_revision() + 1
     if final_rev == 0:
         final_rev = youngest_rev
-    for rev in xrange(first_rev, final_rev + 1):
-        export_revision(rev, repos_obj, fs_obj, pool)
+
+    # one pool for all revisions, cleared before each
+    revpool = svn_pool_create(pool)
+    count = 0
+    if workers != None:
+        revisions = prefetched_revisions(workers, first_rev, final_rev)
+    else:
+        revisions = ((rev, None) for rev in xrange(first_rev, final_rev + 1))
+    for rev, files in revisions:
+        svn_pool_clear(revpool)
+        if files != None:
+            exported = export_prefetched(rev, files, fs_obj, revpool)
+        else:
+            exported = export_revision(rev, repos_obj, fs_obj, revpool)
+        if exported:
+            count += 1
+        if rev % progress_every == 0 or rev == final_rev:
+            sys.stderr.write("Exported revision %d/%d, %d commits\n" %
+                             (rev, final_rev, count))
+    svn_pool_destroy(revpool)
+    if workers != None:
+        workers.close()
+        workers.join()
+    state['rev'] = max(final_rev, first_rev - 1)
 
 
 if __name__ == '__main__':
@@ -135,6 +357,29 @@ if __name__ == '__main__':
                       dest='branches_path', metavar='BRANCHES_PATH')
     parser.add_option('-T', '--tags-path', help='Path in repo to /tags',
                       dest='tags_path', metavar='TAGS_PATH')
+    parser.add_option('--fast-import', help='Feed a git-fast-import child '
+                      'started with these options instead of stdout',
+                      dest='fast_import', metavar='OPTIONS')
+    parser.add_option('--marks', help='Marks file git-fast-import exported '
+                      'in earlier runs; git-fast-import has to run with '
+                      '--import-marks-if-exists=MARKS --export-marks=MARKS, '
+                      'which --fast-import passes on by itself',
+                      dest='marks', metavar='MARKS')
+    parser.add_option('--state', help='File keeping the last exported '
+                      'revision and the branch heads; a run continues '
+                      'after the last one', dest='state', metavar='STATE')
+    parser.add_option('--readers', help='Read file contents in N worker '
+                      'processes ahead of the commits', dest='readers',
+                      metavar='N', type='int')
+    parser.add_option('--prefetch-revisions', help='Read at most this many '
+                      'revisions ahead (default %d)' % prefetch_revisions,
+                      dest='prefetch_revisions', metavar='REVISIONS', type='int')
+    parser.add_option('--prefetch-mb', help='Hold at most this many MB of '
+                      'contents read ahead (default %d)' % (prefetch_bytes >> 20),
+                      dest='prefetch_mb', metavar='MB', type='int')
+    parser.add_option('--blobs', help='File keeping the MD5 of the contents '
+                      'of every blob with its mark across runs',
+                      dest='blobs', metavar='BLOBS')
     (options, args) = parser.parse_args()
 
     if options.trunk_path != None:
@@ -145,16 +390,45 @@ if __name__ == '__main__':
         tags_path = options.tags_path
     if options.final_rev != None:
         final_rev = options.final_rev
+    if options.readers != None:
+        readers = options.readers
+    if options.prefetch_revisions != None:
+        prefetch_revisions = max(options.prefetch_revisions, 1)
+    if options.prefetch_mb != None:
+        prefetch_bytes = options.prefetch_mb << 20
 
     if len(args) != 1:
         parser.print_help()
         sys.exit(2)
+    if options.state != None and options.marks == None:
+        parser.error('--state needs the --marks of git-fast-import')
 
     # Canonicalize (enough for Subversion, at least) the repository path.
     repos_path = os.path.normpath(args[0])
     if repos_path == '.': 
         repos_path = ''
 
+    old_marks = load_cache(options.marks, int)
+    blob_marks = load_cache(options.blobs, get_value=int)
+    state = load_cache(options.state)
+    # don't hand out a blob mark of an earlier run again
+    next_mark = max([cfg_blob_mark_base] + blob_marks.values() +
+                    [m for m in old_marks.keys() if m > cfg_blob_mark_base]) + 1
+
+    fast_import = options.fast_import
+    if fast_import != None and options.marks != None:
+        # the marks of earlier runs must survive a run without new ones
+        fast_import += ' --import-marks-if-exists=%s --export-marks=%s' % (
+            pipes.quote(options.marks), pipes.quote(options.marks))
+    out = writer(fast_import=fast_import)
+
     # Call the app-wrapper, which takes care of APR initialization/shutdown
     # and the creation and cleanup of our top-level memory pool.
     run_app(crawl_revisions, repos_path)
+
+    status = out.close()
+    if options.blobs != None:
+        save_cache(options.blobs, blob_marks)
+    if options.state != None:
+        save_cache(options.state, state)
+    sys.exit(status and 1 or 0)